@@ -1,28 +1,836 @@
-import yaml
 import os
-import sys, getopt, getpass
-import subprocess
-import hashlib
-import tarfile
+import copy
+import functools
+import sys, getopt
+import json
+import contextlib
+import glob
+import io
+import base64
 import re
 import shutil
-from urllib import request
+import threading
+import time
+import struct
+import zlib
+from collections import deque
+# yaml, subprocess, hashlib, tarfile, gzip, zipfile, configparser, asyncio,
+# concurrent.futures, urllib and cProfile are imported by the stages using
+# them, so that --help and render only runs start fast
 
 SCHEMA_KUSTOMIZATION_TEMPLATE = 'templates_flux/kustomization.template'
 SCHEMA_BASE_TEMPLATES = 'templates_flux/base/'
+SCHEMA_BASE_HELMREPO_TEMPLATE = SCHEMA_BASE_TEMPLATES + 'helmrepository.template'
+SCHEMA_BASE_KUSTOMIZATION_TEMPLATE = SCHEMA_BASE_TEMPLATES + 'kustomization.template'
+SCHEMA_BASE_NAMESPACE_TEMPLATE = SCHEMA_BASE_TEMPLATES + 'namespace.template'
 SCHEMA_MANIFEST_TEMPLATE = 'templates_flux/fluxcd-manifest'
+SCHEMA_MANIFEST_HELMRELEASE_TEMPLATE = SCHEMA_MANIFEST_TEMPLATE + '/helmrelease.template'
+SCHEMA_MANIFEST_KUSTOMIZATION_TEMPLATE = SCHEMA_MANIFEST_TEMPLATE + '/kustomization.template'
 SCHEMA_COMMON_TEMPLATE = 'templates_plugins/common.template'
 SCHEMA_HELM_TEMPLATE = 'templates_plugins/helm.template'
 SCHEMA_KUSTOMIZE_TEMPLATE = 'templates_plugins/kustomize.template'
 SCHEMA_LIFECYCLE_TEMPLATE = 'templates_plugins/lifecycle.template'
+REQUIRED_TEMPLATES = [
+    SCHEMA_KUSTOMIZATION_TEMPLATE,
+    SCHEMA_BASE_HELMREPO_TEMPLATE,
+    SCHEMA_BASE_KUSTOMIZATION_TEMPLATE,
+    SCHEMA_BASE_NAMESPACE_TEMPLATE,
+    SCHEMA_MANIFEST_HELMRELEASE_TEMPLATE,
+    SCHEMA_MANIFEST_KUSTOMIZATION_TEMPLATE,
+    SCHEMA_COMMON_TEMPLATE,
+    SCHEMA_HELM_TEMPLATE,
+    SCHEMA_KUSTOMIZE_TEMPLATE,
+    SCHEMA_LIFECYCLE_TEMPLATE]
 APP_GEN_PY_PATH = os.path.split(os.path.realpath(__file__))[0]
+APP_GEN_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'app-gen')
+CHART_CACHE_DIR = APP_GEN_CACHE_DIR + '/charts'
+CHART_CACHE_SIZE = 1024 # MiB
+CHUNK_SIZE = 1024 * 1024
+FETCH_CACHE_DIR = APP_GEN_CACHE_DIR + '/fetch'
+FETCH_CACHE_SIZE = 4096 # MiB
+VALIDATION_CACHE_DIR = APP_GEN_CACHE_DIR + '/validated'
+BUILD_MANIFEST_FILE = '.app-gen-manifest.json'
+COMPRESS_MODES = ['gzip', 'pgzip', 'store']
+PGZIP_JOBS = os.cpu_count() or 1
+BATCH_JOBS = os.cpu_count() or 1
+PREFETCH_JOBS = 8
+PREFETCH_HOST_JOBS = 4
+PREFETCH_RETRIES = 3
+PREFETCH_BACKOFF = 0.5 # seconds, doubled on every retry
+PREFETCH_TIMEOUT = 30 # seconds without data from the server
+WATCH_INTERVAL = 0.25 # seconds
+SERVE_HOSTS = ['127.0.0.1', 'localhost', '::1']
+SERVE_MAX_MANIFEST = 16 * 1024 * 1024
+SERVE_CONTENT_TYPES = ['application/yaml', 'application/x-yaml', 'text/yaml']
+WHEEL_DEFAULT_VERSION = '1.0.0'
+# setup.cfg metadata keys written to the wheel METADATA
+WHEEL_METADATA_FIELDS = {
+    'summary': 'Summary',
+    'url': 'Home-page',
+    'home-page': 'Home-page',
+    'author': 'Author',
+    'author-email': 'Author-email',
+    'author_email': 'Author-email',
+    'maintainer': 'Maintainer',
+    'maintainer-email': 'Maintainer-email',
+    'license': 'License',
+    'keywords': 'Keywords',
+    'python-requires': 'Requires-Python',
+    'python_requires': 'Requires-Python',
+    'classifier': 'Classifier',
+    'classifiers': 'Classifier',
+}
 
 def to_camel_case(s):
     return s[0].lower() + s.title().replace('_','')[1:] if s else s
 
+
+class TemplatePlan:
+    """
+    flux template compiled once into a render plan.
+
+    Every line is parsed into literal segments and $VALUE%default$
+    placeholders, plus its @BLOCK|indent@ placeholder if any. Rendering keeps
+    the line based rules of the templates: a line where no value was
+    substituted is replaced by its yaml block, and lines without any
+    placeholder are joined into a single literal.
+    """
+
+    VALUE_PATTERN = re.compile(r'\$.+?\$')
+    BLOCK_PATTERN = re.compile(r'@\S+\|\d+@')
+
+    def __init__(self, lines):
+        self._nodes = []
+        literal = ''
+        for line in lines:
+            segments = []
+            pos = 0
+            for match in self.VALUE_PATTERN.finditer(line):
+                segments.append(line[pos:match.start()])
+                result_word = match.group().strip('$').split('%')
+                value_default = result_word[1] if len(result_word) > 1 else ''
+                # underscore case to camel case
+                segments.append((match.group(), to_camel_case(result_word[0]), value_default))
+                pos = match.end()
+            segments.append(line[pos:])
+
+            block = None
+            result = self.BLOCK_PATTERN.search(line)
+            if result:
+                block_key = result.group().strip('@').split('|')
+                block = (block_key[0].lower(), int(block_key[1]))
+
+            if len(segments) == 1 and not block:
+                literal += line
+                continue
+            if literal:
+                self._nodes.append(literal)
+                literal = ''
+            self._nodes.append((line, segments, block))
+        if literal:
+            self._nodes.append(literal)
+
+
+    # Render the plan against dicts
+    # write_block(key, value, indent) renders the yaml block placeholders
+    def render(self, dicts, write_block):
+        out = []
+        for node in self._nodes:
+            if type(node) is str:
+                out.append(node)
+                continue
+            line, segments, block = node
+            pieces = []
+            substituted = False
+            for segment in segments:
+                if type(segment) is str:
+                    pieces.append(segment)
+                    continue
+                raw, value, value_default = segment
+                if value in dicts:
+                    pieces.append(str(dicts[value]))
+                    substituted = True
+                elif value_default:
+                    pieces.append(value_default)
+                    substituted = True
+                else:
+                    pieces.append(raw)
+            if substituted:
+                out.append(''.join(pieces))
+            elif block:
+                key, indent = block
+                out.append(write_block(key, dicts[key], indent) if key in dicts else '')
+            else:
+                out.append(line)
+        return ''.join(out)
+
+
+class TemplateRegistry:
+    """
+    templates of templates_flux/ and templates_plugins/, loaded once.
+
+    Templates are read from disk a single time and served from memory, the
+    flux ones compiled into render plans on first use.
+    """
+
+    TEMPLATE_DIRS = ['templates_flux', 'templates_plugins']
+
+    def __init__(self, root=APP_GEN_PY_PATH):
+        self.root = root
+        self._texts = dict()
+        self._plans = dict()
+        self._lock = threading.Lock()
+
+
+    # Read every template, return the required templates that are missing
+    def load(self) -> list:
+        for template_dir in self.TEMPLATE_DIRS:
+            for parent, dirnames, filenames in os.walk(os.path.join(self.root, template_dir)):
+                for filename in filenames:
+                    if not filename.endswith('.template'):
+                        continue
+                    path = os.path.join(parent, filename)
+                    with open(path, 'r') as f:
+                        self._texts[os.path.relpath(path, self.root)] = f.read()
+        return [name for name in REQUIRED_TEMPLATES if os.path.normpath(name) not in self._texts]
+
+
+    def text(self, name) -> str:
+        return self._texts[os.path.normpath(name)]
+
+
+    def plan(self, name) -> TemplatePlan:
+        name = os.path.normpath(name)
+        with self._lock:
+            if name not in self._plans:
+                self._plans[name] = TemplatePlan(self._texts[name].splitlines(keepends=True))
+            return self._plans[name]
+
+
+_TEMPLATES = None
+
+# Load the template registry once per process
+# return None if any required template is missing
+def load_templates() -> TemplateRegistry:
+    global _TEMPLATES
+    if _TEMPLATES is None:
+        templates = TemplateRegistry()
+        missing = templates.load()
+        for name in missing:
+            print('File %s not found' % os.path.join(templates.root, name))
+        if missing:
+            return None
+        _TEMPLATES = templates
+    return _TEMPLATES
+
+
+# Fetch state shared by every application generated in the process
+# the git checkouts map a repo dir to the chart subpaths checked out in it
+_FETCH_LOCKS = dict()
+_FETCH_LOCKS_LOCK = threading.Lock()
+_GIT_CHECKOUTS = dict()
+
+
+# pyyaml, with the libyaml loader and dumper when available
+# they are much faster than the pure python ones
+@functools.lru_cache(maxsize=None)
+def _yaml():
+    import yaml
+    if getattr(yaml, '__with_libyaml__', False):
+        return yaml, yaml.CSafeLoader, yaml.CSafeDumper
+    return yaml, yaml.SafeLoader, yaml.SafeDumper
+
+
+def yaml_load(stream):
+    yaml, loader, dumper = _yaml()
+    return yaml.load(stream, Loader=loader)
+
+
+def yaml_dump(data) -> str:
+    yaml, loader, dumper = _yaml()
+    return yaml.dump(data, Dumper=dumper)
+
+
+class YamlCache:
+    """
+    parsed yaml files, keyed by path, mtime and size.
+
+    Application manifests and Chart.yaml files are parsed once per process
+    as long as they are not modified, for every chart and every application
+    of a batch. Callers get their own copy of the parsed data.
+    """
+
+    def __init__(self):
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+
+    def load(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry and entry[0] == key:
+            record('cache_hits')
+        else:
+            record('cache_misses')
+            with open(path) as f:
+                entry = (key, yaml_load(f))
+            with self._lock:
+                self._entries[path] = entry
+        return copy.deepcopy(entry[1])
+
+
+_YAML_CACHE = YamlCache()
+
+def load_yaml_file(path):
+    return _YAML_CACHE.load(path)
+
+
+# Yaml block of a non empty list of strings, indented by init_indent
+# A list is laid out the same way on its own as under a mapping key, so it
+# is dumped directly, without the key line to strip. The same lists, such
+# as the chart names, come back for every chart and application.
+@functools.lru_cache(maxsize=1024)
+def yaml_list_block(items, init_indent) -> str:
+    out = yaml_dump(list(items))
+    indents = ' ' * init_indent
+    return indents + out[:-1].replace('\n', '\n' + indents) + '\n'
+
+
+class ChartCache:
+    """
+    persistent cache of the packaged helm chart tarballs.
+
+    Entries are stored as <cache_dir>/<key>/<chart>-<version>.tgz, where key
+    is a hash of the chart file tree and its Chart.yaml version. The least
+    recently used entries are evicted once the cache grows over max_size MiB.
+    """
+
+    def __init__(self, cache_dir=CHART_CACHE_DIR, max_size=CHART_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size * 1024 * 1024
+        self._lock = threading.Lock()
+
+
+    # variant tells apart the tarballs packaged with different options
+    def key(self, path, variant=''):
+        import hashlib
+        version = str(load_yaml_file(path + '/Chart.yaml').get('version', ''))
+        key = hashlib.sha256(('version:' + version + '\n' + variant).encode())
+        for parent, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(parent, filename)
+                rel_path = os.path.relpath(file_path, path)
+                if os.path.islink(file_path):
+                    key.update(('link:%s:%s\n' % (rel_path, os.readlink(file_path))).encode())
+                    continue
+                mode = os.stat(file_path).st_mode & 0o111
+                key.update(('file:%s:%o\n' % (rel_path, mode)).encode())
+                with open(file_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        key.update(chunk)
+                        record('read', len(chunk))
+        return key.hexdigest()
+
+
+    # Copy a cached tarball to dest_dir
+    # never hard-linked, as helm package rewrites the tarball of a later miss
+    # in place, which would change the cache entry through the link
+    # return the tarball name, or None on cache miss
+    def get(self, key, dest_dir):
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            tarballs = [f for f in os.listdir(entry) if f.endswith('.tgz')]
+        except FileNotFoundError:
+            return None
+        if not tarballs:
+            return None
+        tarball = tarballs[0]
+        dest = os.path.join(dest_dir, tarball)
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            shutil.copy2(os.path.join(entry, tarball), dest)
+            # mark the entry as recently used
+            os.utime(entry)
+        except OSError:
+            # evicted by another process meanwhile, a miss
+            if os.path.exists(dest):
+                os.remove(dest)
+            return None
+        return tarball
+
+
+    def put(self, key, tarball_path):
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_entry = '%s/.tmp-%s-%d-%d' % (self.cache_dir, key, os.getpid(), threading.get_ident())
+        os.makedirs(tmp_entry)
+        shutil.copy2(tarball_path, tmp_entry)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another worker stored the same entry in the meantime
+            shutil.rmtree(tmp_entry)
+        self._evict()
+
+
+    # Remove the least recently used entries until the cache fits max_size
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                entry = os.path.join(self.cache_dir, name)
+                if name.startswith('.') or not os.path.isdir(entry):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+                total += size
+            for mtime, size, entry in sorted(entries):
+                if total <= self.max_size:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+
+class FetchCache:
+    """
+    per-user cache of the fetched git repos and helm chart tarballs.
+
+    Every source gets its own entry, <cache_dir>/<basename>-<hash>, hash
+    being the sha256 of its url and git commit, so that sources with the
+    same basename do not collide. A process holds a shared flock on <entry>.lock
+    while it uses an entry, so that gc() skips it, and an exclusive flock on
+    <entry>.write.lock only while it modifies it, so that parallel runs
+    modify an entry one at a time without waiting for each other's end. The
+    modifications only add to an entry (e.g. widen a git checkout, extract
+    a tarball downloaded again next to the previous one), never change or
+    remove what another run may be using. The size of an entry is saved to
+    <entry>.json once modified, for gc() to evict the least recently used
+    entries.
+    """
+
+    def __init__(self, cache_dir=FETCH_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        # entry -> [lock file descriptor, users in this process]
+        self._users = dict()
+
+
+    def entry(self, url, ref='') -> str:
+        import hashlib
+        if os.path.exists(url):
+            url = os.path.abspath(url)
+        digest = hashlib.sha256(('%s\n%s' % (url, ref)).encode()).hexdigest()[:16]
+        basename = re.sub('[^A-Za-z0-9._-]', '_', os.path.basename(url.rstrip('/')))
+        return os.path.join(self.cache_dir, '%s-%s' % (basename, digest))
+
+
+    # Start using an entry, holding a shared lock on it until release()
+    # the callers hold the fetch lock of the entry
+    def acquire(self, entry):
+        import fcntl
+        with self._lock:
+            if entry in self._users:
+                self._users[entry][1] += 1
+                return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        while True:
+            fd = os.open(entry + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            # gc removes the lock file of the entries it evicts
+            try:
+                if os.stat(entry + '.lock').st_ino == os.fstat(fd).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+        # the lock file mtime is the last use of the entry
+        os.utime(fd)
+        with self._lock:
+            self._users[entry] = [fd, 1]
+
+
+    def release(self, entry):
+        import fcntl
+        with self._lock:
+            self._users[entry][1] -= 1
+            if self._users[entry][1]:
+                return
+            fd = self._users.pop(entry)[0]
+        # other processes may modify it from now on
+        _GIT_CHECKOUTS.pop(entry, None)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+    # Modify an acquired entry, waiting for the other processes modifying it
+    # the shared lock of acquire() is kept as is, it is never upgraded
+    @contextlib.contextmanager
+    def exclusive(self, entry, source):
+        import fcntl
+        fd = os.open(entry + '.write.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                size = 0
+                for parent, dirnames, filenames in os.walk(entry):
+                    for filename in filenames:
+                        size += os.lstat(os.path.join(parent, filename)).st_size
+                with open(entry + '.json', 'w') as f:
+                    json.dump({'source': source, 'size': size}, f)
+        finally:
+            os.close(fd)
+
+
+    # Remove the least recently used entries, skipping the ones in use by any
+    # process, until the cache fits max_size MiB
+    # return the number of entries and bytes removed and the bytes kept
+    def gc(self, max_size):
+        import fcntl
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir) if os.path.isdir(self.cache_dir) else []:
+            if not name.endswith('.lock') or name.endswith('.write.lock'):
+                continue
+            entry = os.path.join(self.cache_dir, name[:-len('.lock')])
+            try:
+                with open(entry + '.json') as f:
+                    size = json.load(f)['size']
+            except (OSError, ValueError, KeyError):
+                size = 0
+            entries.append((os.path.getmtime(entry + '.lock'), size, entry))
+            total += size
+
+        removed = freed = 0
+        for used, size, entry in sorted(entries):
+            if total <= max_size * 1024 * 1024:
+                break
+            fd = os.open(entry + '.lock', os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            try:
+                shutil.rmtree(entry, ignore_errors=True)
+                for suffix in ('.json', '.write.lock', '.lock'):
+                    if os.path.exists(entry + suffix):
+                        os.remove(entry + suffix)
+            finally:
+                os.close(fd)
+            removed += 1
+            freed += size
+            total -= size
+        return removed, freed, total
+
+
+_FETCH_CACHE = FetchCache()
+
+
+class ParallelGzipWriter:
+    """
+    write-only file object compressing to a single standard gzip member.
+
+    The data is cut in blocks compressed on a thread pool, each block primed
+    with the last 32 KiB of the previous one and ended with a sync flush, then
+    written in order, the way pigz does. Any gzip reader can decompress it.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+    WINDOW_SIZE = 32 * 1024
+
+    def __init__(self, fileobj, compresslevel=9, jobs=PGZIP_JOBS, mtime=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self._fileobj = fileobj
+        self._level = compresslevel
+        self._executor = ThreadPoolExecutor(max_workers=jobs)
+        self._max_pending = 2 * jobs
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._window = b''
+        self._crc = 0
+        self._size = 0
+        if mtime is None:
+            mtime = int(time.time())
+        xfl = 2 if compresslevel == 9 else 4 if compresslevel == 1 else 0
+        self._fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<L', mtime) + bytes([xfl, 255]))
+
+
+    def _compress(self, block, window, last):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, \
+                zlib.Z_DEFAULT_STRATEGY, window) if window else \
+                zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+    def _submit(self, block, last=False):
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        self._pending.append(self._executor.submit(self._compress, block, self._window, last))
+        self._window = block[-self.WINDOW_SIZE:]
+        while len(self._pending) > self._max_pending:
+            self._fileobj.write(self._pending.popleft().result())
+
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:self.BLOCK_SIZE]))
+            del self._buffer[:self.BLOCK_SIZE]
+        return len(data)
+
+
+    def tell(self):
+        return self._size + len(self._buffer)
+
+
+    def close(self):
+        if self._executor is None:
+            return
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer = bytearray()
+        while self._pending:
+            self._fileobj.write(self._pending.popleft().result())
+        self._executor.shutdown()
+        self._executor = None
+        self._fileobj.write(struct.pack('<LL', self._crc, self._size & 0xffffffff))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class OutputStager:
+    """
+    rendered files of an application, written to disk in bulk.
+
+    Files and directories are collected in memory, then written to a staging
+    dir next to the output dir, which is swapped into place. A failing
+    generation leaves the previous output dir untouched.
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.files = dict()
+        self.dirs = set()
+
+
+    # Add a file, path being absolute inside output_dir or relative to it
+    def add(self, path, content=''):
+        self.files[os.path.relpath(os.path.join(self.output_dir, path), self.output_dir)] = content
+
+
+    def add_dir(self, path):
+        self.dirs.add(os.path.relpath(os.path.join(self.output_dir, path), self.output_dir))
+
+
+    def _write(self, root, rel_path, content):
+        if not isinstance(content, bytes):
+            content = content.encode()
+        with open(os.path.join(root, rel_path), 'wb') as f:
+            f.write(content)
+        record('written', len(content))
+
+
+    # sha256 of every staged file
+    def digests(self) -> dict:
+        import hashlib
+        digests = dict()
+        for rel_path, content in self.files.items():
+            if not isinstance(content, bytes):
+                content = content.encode()
+            digests[rel_path] = hashlib.sha256(content).hexdigest()
+        return digests
+
+
+    # Write in place only the files whose content differs from the previous
+    # digests, and remove the previous files that are no longer generated.
+    # Unchanged files keep their bytes and mtime. Return the changed files.
+    def commit_incremental(self, previous):
+        digests = self.digests()
+        dirs = self.dirs | {os.path.dirname(rel_path) for rel_path in self.files}
+        for rel_path in sorted(dirs):
+            os.makedirs(os.path.join(self.output_dir, rel_path), exist_ok=True)
+
+        changed = []
+        for rel_path, content in self.files.items():
+            path = os.path.join(self.output_dir, rel_path)
+            if previous.get(rel_path) == digests[rel_path] and os.path.exists(path):
+                continue
+            self._write(self.output_dir, rel_path + '.tmp', content)
+            os.replace(path + '.tmp', path)
+            changed.append(rel_path)
+        for rel_path in previous:
+            if rel_path not in self.files:
+                if os.path.exists(os.path.join(self.output_dir, rel_path)):
+                    os.remove(os.path.join(self.output_dir, rel_path))
+                changed.append(rel_path)
+        return sorted(changed)
+
+
+    def commit(self):
+        parent, name = os.path.split(self.output_dir.rstrip('/'))
+        staging_dir = '%s/.%s.staging-%d-%d' % (parent, name, os.getpid(), threading.get_ident())
+        try:
+            dirs = self.dirs | {os.path.dirname(rel_path) for rel_path in self.files}
+            for rel_path in sorted(dirs):
+                os.makedirs(os.path.join(staging_dir, rel_path), exist_ok=True)
+            for rel_path, content in self.files.items():
+                self._write(staging_dir, rel_path, content)
+
+            # swap the staging dir into place
+            if os.path.exists(self.output_dir):
+                old_dir = '%s/.%s.old-%d-%d' % (parent, name, os.getpid(), threading.get_ident())
+                os.rename(self.output_dir, old_dir)
+                os.rename(staging_dir, self.output_dir)
+                shutil.rmtree(old_dir)
+            else:
+                os.rename(staging_dir, self.output_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+class Span:
+    """
+    one timed stage or chart of the application generation.
+    """
+
+    def __init__(self, name, cat, parent):
+        self.name = name
+        self.cat = cat
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.tid = threading.get_ident()
+        self.start = 0.0
+        self.duration = 0.0
+        self.counters = dict.fromkeys(Timings.COUNTERS, 0)
+
+
+class Timings:
+    """
+    instrumentation of the application generation.
+
+    Records the wall time of nested spans (stages, charts, apps of a batch)
+    and the subprocess time, bytes read and written and cache hits and misses
+    spent in them, each counter being added to every enclosing span. Printed
+    as a table or written as a Chrome trace. With profile set, the spans
+    opened with profile=True also run under cProfile.
+    """
+
+    COUNTERS = ['subprocess', 'read', 'written', 'cache_hits', 'cache_misses']
+
+    def __init__(self, profile=False):
+        self.spans = []
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+
+    # Time the enclosed code
+    # the parent is the current span of the thread unless given, i.e. for the
+    # spans of worker threads
+    @contextlib.contextmanager
+    def span(self, name, cat='stage', parent=None, profile=False):
+        previous = current_span()
+        span = Span(name, cat, parent or previous)
+        with self._lock:
+            self.spans.append(span)
+        _SPANS.current = span
+        profile = profile and self.profiler
+        if profile:
+            self.profiler.enable()
+        span.start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - span.start
+            if profile:
+                self.profiler.disable()
+            _SPANS.current = previous
+
+
+    def table(self) -> str:
+        lines = ['%-44s %9s %9s %10s %10s %7s' % ('stage', 'wall', 'subproc', 'read', 'written', 'cache')]
+        # every span below its parent
+        children = dict()
+        for span in sorted(self.spans, key=lambda s: s.start, reverse=True):
+            children.setdefault(span.parent, []).append(span)
+        pending = children.get(None, [])
+        while pending:
+            span = pending.pop()
+            pending.extend(children.get(span, []))
+            counters = span.counters
+            cache = '-'
+            if counters['cache_hits'] or counters['cache_misses']:
+                cache = '%d/%d' % (counters['cache_hits'], counters['cache_hits'] + counters['cache_misses'])
+            lines.append('%-44s %8.3fs %8.3fs %10s %10s %7s' % (('  ' * span.depth + span.name)[:44], \
+                    span.duration, counters['subprocess'], format_size(counters['read']), \
+                    format_size(counters['written']), cache))
+        return '\n'.join(lines)
+
+
+    # Chrome trace event format, for chrome://tracing or ui.perfetto.dev
+    def write_trace(self, path):
+        events = []
+        for span in self.spans:
+            events.append({
+                'name': span.name,
+                'cat': span.cat,
+                'ph': 'X',
+                'ts': round((span.start - self._origin) * 1e6),
+                'dur': round(span.duration * 1e6),
+                'pid': os.getpid(),
+                'tid': span.tid,
+                'args': span.counters,
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, indent=1)
+
+
+_SPANS = threading.local()
+_SPANS_LOCK = threading.Lock()
+
+def current_span() -> Span:
+    return getattr(_SPANS, 'current', None)
+
+
+# Add value to a counter of the current span of the thread and its parents
+def record(counter, value=1):
+    span = current_span()
+    with _SPANS_LOCK:
+        while span:
+            span.counters[counter] += value
+            span = span.parent
+
+
+def format_size(size) -> str:
+    if size < 1024:
+        return '%d B' % size
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024
+        if size < 1024 or unit == 'GiB':
+            return '%.1f %s' % (size, unit)
+
+
 class FluxApplication:
 
-    def __init__(self, app_data):
+    def __init__(self, app_data, templates=None):
 
         # Initialize application config
         self._flux_manifest = {}
@@ -54,11 +862,103 @@ class FluxApplication:
         # Initialize metadata
         self.metadata = app_data['metadataFile-config']
 
+        # Initialize templates
+        self._templates = templates or load_templates()
+
+        # Initialize helm chart packaging workers
+        self._jobs = 1
+        self._abort = threading.Event()
+        self._procs = set()
+        self._procs_lock = threading.Lock()
+        self._git_fetched = dict()
+        self._tarballs = dict()
+        self._fetch_cache = _FETCH_CACHE
+        self._fetch_entries = set()
+        self._chart_cache = None
+        self._reproducible = False
+        self._stager = None
+        self._timings = None
+        self._compress = 'gzip'
+        self._compress_level = 9
+        self._prefetch = None
 
     def get_app_name(self):
         return self._flux_manifest['appName']
 
 
+    # Run a command for the helm chart packaging workers
+    # every process is registered so that a failing chart can stop the
+    # helm and git processes of all other charts right away
+    #
+    def _run_cmd(self, cmd, cwd=None):
+        import subprocess
+        if self._abort.is_set():
+            return subprocess.CompletedProcess(cmd, -1, b'', b'Aborted\n')
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=cwd, env=os.environ.copy(), \
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with self._procs_lock:
+            self._procs.add(proc)
+            if self._abort.is_set():
+                proc.kill()
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            with self._procs_lock:
+                self._procs.discard(proc)
+            record('subprocess', time.perf_counter() - start)
+        return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+    # Time a stage or chart when instrumentation is enabled
+    #
+    def _span(self, name, cat='stage', parent=None, profile=False):
+        if not self._timings:
+            return contextlib.nullcontext()
+        return self._timings.span(name, cat, parent, profile)
+
+
+    # Stop every running helm chart packaging worker
+    #
+    def _abort_helm_charts(self):
+        self._abort.set()
+        with self._procs_lock:
+            for proc in self._procs:
+                proc.kill()
+
+
+    # Lock shared by the charts fetched from the same git repo or tarball,
+    # in this application or in any other one of the same batch
+    #
+    def _fetch_lock(self, key):
+        with _FETCH_LOCKS_LOCK:
+            return _FETCH_LOCKS.setdefault(key, threading.Lock())
+
+
+    # Use a fetch cache entry until release_fetch_entries()
+    # the caller holds the fetch lock of the entry
+    #
+    def _use_fetch_entry(self, entry):
+        if entry not in self._fetch_entries:
+            self._fetch_cache.acquire(entry)
+            self._fetch_entries.add(entry)
+
+
+    # Let the other processes modify the fetch cache entries used by the app
+    #
+    def release_fetch_entries(self):
+        for entry in self._fetch_entries:
+            with self._fetch_lock(entry):
+                self._fetch_cache.release(entry)
+        self._fetch_entries = set()
+
+
+    # Per-chart log, printed in the manifest order once the chart is done
+    #
+    def _chart_print(self, chart, msg):
+        chart['_log'].append(msg)
+
+
     # Sub-process of app generation
     # generate application helm-charts tarball
     #
@@ -67,32 +967,310 @@ class FluxApplication:
 
         # lint helm chart
         cmd_lint = ['helm', 'lint', path]
-        subproc = subprocess.run(cmd_lint, env=os.environ.copy(), \
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        subproc = self._run_cmd(cmd_lint)
         if subproc.returncode == 0:
-            print(str(subproc.stdout, encoding = 'utf-8'))
+            self._chart_print(chart, str(subproc.stdout, encoding = 'utf-8'))
         else:
-            print(str(subproc.stderr, encoding = 'utf-8'))
+            self._chart_print(chart, str(subproc.stderr, encoding = 'utf-8'))
             return False
 
         # package helm chart
         cmd_package = ['helm', 'package', path, \
                 '--destination=' + self._flux_manifest['outputChartDir']]
-        subproc = subprocess.run(cmd_package, env=os.environ.copy(), \
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        subproc = self._run_cmd(cmd_package)
         if subproc.returncode == 0:
             output = str(subproc.stdout, encoding = 'utf-8')
-            print(output)
+            self._chart_print(chart, output)
             # capture tarball name
             for words in output.split('/'):
                 if 'tgz' in words:
                     chart['tarballName'] = words.rstrip('\n')
         else:
-            print(subproc.stderr)
+            self._chart_print(chart, str(subproc.stderr, encoding = 'utf-8'))
             return False
         return True
 
 
+    # Sub-process of app generation
+    # fetch the git repo of a chart
+    # The chart 'ref' (branch, tag or full commit sha, HEAD by default) is
+    # resolved to a commit, fetched into the fetch cache entry of that commit
+    # with depth 1, and only the subpaths of the charts using it are checked
+    # out. A branch moving upstream gets a new entry, the checkout of an entry
+    # never changes under the runs using it. Charts from the same repo at the
+    # same ref share the fetch, also across the applications of a batch,
+    # which only widen the checkout to their subpaths. A commit checked out by
+    # a previous run is reused as is. Return the repo dir, or None on failure.
+    #
+    def _fetch_git_repo(self, chart):
+        ref = str(chart.get('ref', ''))
+        key = 'git:%s@%s' % (chart['path'], ref)
+
+        with self._fetch_lock(key):
+            if key in self._git_fetched:
+                if not self._git_fetched[key]:
+                    self._chart_print(chart, 'Error: git fetch %s failed' % chart['_gitname'])
+                return self._git_fetched[key]
+            self._git_fetched[key] = None
+            commit = ref if re.fullmatch('[0-9a-f]{40}', ref) else self._git_resolve_ref(chart, ref)
+            if not commit:
+                return None
+            repo_dir = self._fetch_cache.entry(chart['path'], commit)
+            with self._fetch_lock(repo_dir):
+                self._use_fetch_entry(repo_dir)
+                repo_dir = self._git_checkout(chart, ref, commit, repo_dir)
+            self._git_fetched[key] = repo_dir
+            return repo_dir
+
+
+    # Commit of ref in the git repo of a chart, None on failure
+    # ref is tried as a full ref name, then as a tag and as a branch, as git
+    # fetch does. Annotated tags are peeled to their commit.
+    #
+    def _git_resolve_ref(self, chart, ref):
+        subproc = self._run_cmd(['git', 'ls-remote', chart['path'], ref or 'HEAD'])
+        if subproc.returncode != 0:
+            self._chart_print(chart, str(subproc.stderr, encoding = 'utf-8'))
+            self._chart_print(chart, 'Error: git ls-remote %s failed' % chart['_gitname'])
+            return None
+        commits = dict()
+        for line in str(subproc.stdout, encoding = 'utf-8').splitlines():
+            commit, _, name = line.partition('\t')
+            commits[name] = commit
+        for name in (ref or 'HEAD', 'refs/' + ref, 'refs/tags/' + ref, 'refs/heads/' + ref):
+            if name in commits:
+                return commits.get(name + '^{}', commits[name])
+        self._chart_print(chart, 'Error: ref %s not found in %s' % (ref or 'HEAD', chart['_gitname']))
+        return None
+
+
+    # Check out the subpaths of the charts of the repo at ref in repo_dir, the
+    # fetch cache entry of commit
+    # the caller holds the fetch lock of repo_dir
+    #
+    def _git_checkout(self, chart, ref, commit, repo_dir):
+        key = 'git:%s@%s' % (chart['path'], ref)
+        subpaths = sorted({os.path.normpath(c['subpath']).strip('/') for c in self._flux_chart \
+                if c['_pathType'] == 'git' and c['path'] == chart['path'] \
+                and str(c.get('ref', '')) == ref})
+        checkout = _GIT_CHECKOUTS.get(repo_dir)
+        if checkout is None:
+            checkout = self._git_checkout_at(repo_dir, commit)
+        cmds = []
+        if checkout is not None:
+            # already fetched for another application
+            if [subpath for subpath in subpaths if subpath not in checkout]:
+                with self._fetch_cache.exclusive(repo_dir, key):
+                    # another run may have widened the checkout meanwhile
+                    checkout = self._git_sparse_paths(repo_dir) or set()
+                    missing = [subpath for subpath in subpaths if subpath not in checkout]
+                    if '.' in missing:
+                        cmds.append(['git', 'sparse-checkout', 'disable'])
+                    elif missing and '.' not in checkout:
+                        cmds.append(['git', 'sparse-checkout', 'add'] + missing)
+                    for cmd in cmds:
+                        subproc = self._run_cmd(cmd, cwd=repo_dir)
+                        if subproc.returncode != 0:
+                            self._chart_print(chart, str(subproc.stderr, encoding = 'utf-8'))
+                            self._chart_print(chart, 'Error: git checkout %s failed' % chart['_gitname'])
+                            return None
+            _GIT_CHECKOUTS[repo_dir] = checkout | set(subpaths)
+            return repo_dir
+
+        with self._fetch_cache.exclusive(repo_dir, key):
+            # other runs may be using the subpaths checked out, they are
+            # kept
+            checkout = set()
+            if not os.path.exists(repo_dir + '/.git'):
+                os.makedirs(repo_dir, exist_ok=True)
+                cmds.append(['git', 'init', '-q'])
+                cmds.append(['git', 'remote', 'add', 'origin', chart['path']])
+            else:
+                checkout = self._git_sparse_paths(repo_dir) or set()
+            checkout |= set(subpaths)
+            if '.' in checkout:
+                cmds.append(['git', 'sparse-checkout', 'disable'])
+            else:
+                cmds.append(['git', 'sparse-checkout', 'set', '--cone'] + sorted(checkout))
+            cmds.append(['git', 'fetch', '-q', '--depth', '1', '--filter=blob:none', 'origin', commit])
+            cmds.append(['git', 'checkout', '-q', '--force', 'FETCH_HEAD'])
+
+            for cmd in cmds:
+                subproc = self._run_cmd(cmd, cwd=repo_dir)
+                if subproc.returncode != 0:
+                    self._chart_print(chart, str(subproc.stderr, encoding = 'utf-8'))
+                    self._chart_print(chart, 'Error: git fetch %s failed' % chart['_gitname'])
+                    return None
+
+        _GIT_CHECKOUTS[repo_dir] = checkout
+        return repo_dir
+
+
+    # Subpaths checked out in repo_dir if it is at commit ref, '.' for all,
+    # None otherwise
+    #
+    def _git_checkout_at(self, repo_dir, ref):
+        if not os.path.exists(repo_dir + '/.git'):
+            return None
+        subproc = self._run_cmd(['git', 'rev-parse', 'HEAD'], cwd=repo_dir)
+        if subproc.returncode != 0 or str(subproc.stdout, encoding = 'utf-8').strip() != ref:
+            return None
+        return self._git_sparse_paths(repo_dir)
+
+
+    # Subpaths checked out in repo_dir, '.' for all, None on failure
+    #
+    def _git_sparse_paths(self, repo_dir):
+        subproc = self._run_cmd(['git', 'config', '--bool', 'core.sparseCheckout'], cwd=repo_dir)
+        if str(subproc.stdout, encoding = 'utf-8').strip() != 'true':
+            return {'.'}
+        subproc = self._run_cmd(['git', 'sparse-checkout', 'list'], cwd=repo_dir)
+        if subproc.returncode != 0:
+            return None
+        return {os.path.normpath(line).strip('/') for line in str(subproc.stdout, encoding = 'utf-8').split()}
+
+
+    # Download the tarball of a chart, or check the local one
+    # Charts from the same tarball share it, it is downloaded into its fetch
+    # cache entry and checked against its sha256 once. Return the tarball
+    # path, or None on failure.
+    #
+    def _fetch_tarball(self, chart):
+        entry = self._fetch_cache.entry(chart['path'])
+        # charts from the same tarball are downloaded one at a time
+        with self._fetch_lock(entry):
+            if chart['path'] in self._tarballs:
+                if not self._tarballs[chart['path']]:
+                    self._chart_print(chart, 'Error: fetch of %s failed' % chart['path'])
+                return self._tarballs[chart['path']]
+            self._tarballs[chart['path']] = None
+            self._use_fetch_entry(entry)
+
+            # check whether it's a url or local tarball
+            if not os.path.exists(chart['path']):
+                # download tarball, unless a previous run did
+                tarpath = entry + '/' + chart['_tarname'] + '.tgz'
+                sha256 = chart.get('sha256')
+                if not os.path.exists(tarpath) or sha256 and file_sha256(tarpath) != sha256.lower():
+                    with self._fetch_cache.exclusive(entry, chart['path']):
+                        os.makedirs(entry, exist_ok=True)
+                        # the download replaces the cached tarball at once,
+                        # the runs reading it keep reading the previous one
+                        if os.path.exists(tarpath) and sha256 and file_sha256(tarpath) != sha256.lower():
+                            self._chart_print(chart, 'Cached %s does not match its sha256, downloading it again' % tarpath)
+                            download_file(chart['path'], tarpath, sha256)
+                        elif not os.path.exists(tarpath):
+                            download_file(chart['path'], tarpath, sha256)
+            else:
+                tarpath = chart['path']
+                if chart.get('sha256') and file_sha256(tarpath) != chart['sha256'].lower():
+                    self._chart_print(chart, 'Error: %s does not match its sha256' % tarpath)
+                    return None
+
+            self._tarballs[chart['path']] = tarpath
+            return tarpath
+
+
+    # Start fetching the git repos and tarballs of the charts in the background
+    # An asyncio loop, in its own thread, runs the fetchers above in a thread
+    # pool with at most PREFETCH_HOST_JOBS fetches per host and retries the
+    # remote ones with an exponential backoff. The sources are memoized by the
+    # fetchers, so the validation and packaging reuse them once
+    # _wait_prefetch() returned. Sources that are only needed for a validation
+    # already cached are skipped when the charts are not packaged.
+    #
+    def _start_prefetch(self, no_package):
+        sources = dict()
+        for chart in self._flux_chart:
+            if chart['_pathType'] == 'dir':
+                continue
+            source = self._validation_source(chart)
+            if no_package and source and _VALIDATION_CACHE.contains(validation_key(source, chart)):
+                continue
+            chart.setdefault('_log', [])
+            if chart['_pathType'] == 'tarball':
+                sources.setdefault(chart['path'], (chart, self._fetch_tarball, self._tarballs))
+            else:
+                key = 'git:%s@%s' % (chart['path'], chart.get('ref', ''))
+                sources.setdefault(key, (chart, self._fetch_git_repo, self._git_fetched))
+        if not sources:
+            return
+
+        import asyncio
+        pipeline = self._prefetch_sources(sources, current_span())
+        self._prefetch = threading.Thread(target=asyncio.run, args=(pipeline,), daemon=True)
+        self._prefetch.start()
+
+
+    async def _prefetch_sources(self, sources, parent_span):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        loop = asyncio.get_running_loop()
+        host_slots = dict()
+
+        async def prefetch(key, chart, fetch, fetched):
+            host = fetch_host(chart['path'])
+            slots = host_slots.setdefault(host, asyncio.Semaphore(PREFETCH_HOST_JOBS))
+            for attempt in range(PREFETCH_RETRIES + 1):
+                async with slots:
+                    ret, transient = await loop.run_in_executor(executor, self._prefetch_source, \
+                            chart, fetch, parent_span)
+                # local sources are not retried
+                if ret or not transient or not host or attempt == PREFETCH_RETRIES or self._abort.is_set():
+                    return
+                delay = PREFETCH_BACKOFF * 2 ** attempt
+                self._chart_print(chart, 'Retrying fetch of %s in %.1fs' % (chart['path'], delay))
+                await asyncio.sleep(delay)
+                # forget the failure so that the fetcher tries again
+                fetched.pop(key, None)
+
+        with ThreadPoolExecutor(max_workers=PREFETCH_JOBS) as executor:
+            await asyncio.gather(*(prefetch(key, *source) for key, source in sources.items()))
+
+
+    # Fetch the source of a chart, return (fetched, whether a failure may be
+    # transient)
+    #
+    def _prefetch_source(self, chart, fetch, parent_span):
+        name = chart['_tarname'] if chart['_pathType'] == 'tarball' else chart['_gitname']
+        with self._span('fetch ' + name, 'fetch', parent_span):
+            try:
+                return fetch(chart) is not None, True
+            except ValueError as e:
+                # e.g. a sha256 mismatch, the same bytes are downloaded again
+                self._chart_print(chart, 'Error: %s' % e)
+                return False, False
+            except Exception as e:
+                self._chart_print(chart, 'Error: %s' % e)
+                # a missing or forbidden file does not show up on retry,
+                # timeouts and other network errors may
+                code = getattr(e, 'code', None)
+                return False, not (isinstance(code, int) and 400 <= code < 500 and code not in (408, 429))
+
+
+    # Wait for the background fetches, stopping them first if abort is set
+    #
+    def _wait_prefetch(self, abort=False):
+        if not self._prefetch:
+            return
+        if abort:
+            self._abort_helm_charts()
+        self._prefetch.join()
+        self._prefetch = None
+
+
+    # Folder the chart subpath of tarpath is extracted to in its fetch cache
+    # entry, one per tarball size and mtime: a tarball downloaded again or
+    # changed is extracted next to the previous one, which other runs may be
+    # using
+    #
+    def _extract_path(self, chart, entry, tarpath):
+        tar_stat = os.stat(tarpath)
+        return os.path.normpath('%s/%s-%d-%d/%s' % (entry, chart['_tarname'], tar_stat.st_size, \
+                tar_stat.st_mtime_ns, chart['subpath']))
+
+
     # Sub-process of app generation
     # lint and package helm chart
     # TODO: sub-chart dependency check
@@ -100,91 +1278,142 @@ class FluxApplication:
     def _gen_helm_chart_tarball(self, chart):
         ret = False
         path = ''
-        print('Processing chart %s...' % chart['name'])
+        self._chart_print(chart, 'Processing chart %s...' % chart['name'])
         # check pathtype of the chart
         if chart['_pathType'] == 'git':
-            gitname = ''
-            # download git
-            if not os.path.exists(TEMP_APP_DIR):
-                os.makedirs(TEMP_APP_DIR)
-            # if the git folder exists, check git name and use that folder
-            # otherwise git clone from upstream
-            if not os.path.exists(TEMP_APP_DIR + chart['_gitname']):
-                saved_pwd = os.getcwd()
-                os.chdir(TEMP_APP_DIR)
-                cmd = ['git', 'clone', chart['path']]
-                subproc = subprocess.run(cmd, env=os.environ.copy(), \
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if subproc.returncode != 0:
-                    output = str(subproc.stderr, encoding = 'utf-8')
-                    print(output)
-                    print('Error: git clone %s failed' % chart['_gitname'])
-                    os.chdir(saved_pwd)
-                    return False
-                os.chdir(saved_pwd)
-            else:
-                # git pull to ensure folder up-to-date
-                saved_pwd = os.getcwd()
-                os.chdir(TEMP_APP_DIR + chart['_gitname'])
-                cmd = ['git', 'pull']
-                subproc = subprocess.run(cmd, env=os.environ.copy(), \
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if subproc.returncode != 0:
-                    output = str(subproc.stderr, encoding = 'utf-8')
-                    print(output)
-                    print('Error: git pull for %s failed' % chart['_gitname'])
-                    os.chdir(saved_pwd)
-                    return False
-                os.chdir(saved_pwd)
-            path = TEMP_APP_DIR + chart['_gitname'] + '/' + chart['subpath']
+            repo_dir = self._fetch_git_repo(chart)
+            if not repo_dir:
+                return False
+            path = repo_dir + '/' + chart['subpath']
         elif chart['_pathType'] == 'tarball':
-            if not os.path.exists(TEMP_APP_DIR):
-                os.makedirs(TEMP_APP_DIR)
             try:
-                # check whether it's a url or local tarball
-                if not os.path.exists(chart['path']):
-                    # download tarball
-                    tarpath = TEMP_APP_DIR + chart['_tarname'] + '.tgz'
-                    if not os.path.exists(tarpath):
-                        res = request.urlopen(chart['path'])
-                        with open(tarpath, 'wb') as f:
-                            f.write(res.read())
-                else:
-                    tarpath = chart['path']
-                # extract tarball
-                chart_tar = tarfile.open(tarpath, 'r:gz')
-                chart_files = chart_tar.getnames()
-                # get tar arcname for packaging helm chart process
-                # TODO: compatible with the case that there is no arcname
-                chart['_tarArcname'] = chart_files[0].split('/')[0]
-                if not os.path.exists(chart['_tarArcname']):
-                    for chart_file in chart_files:
-                        chart_tar.extract(chart_file, TEMP_APP_DIR)
-                chart_tar.close()
+                tarpath = self._fetch_tarball(chart)
+                if not tarpath:
+                    return False
+                # extract only the chart subpath out of the tarball, unless a
+                # previous run did
+                entry = self._fetch_cache.entry(chart['path'])
+                with self._fetch_lock(entry):
+                    path = self._extract_path(chart, entry, tarpath)
+                    if not os.path.isdir(path):
+                        with self._fetch_cache.exclusive(entry, chart['path']):
+                            # another run may have extracted it, or downloaded
+                            # the tarball again, meanwhile
+                            path = self._extract_path(chart, entry, tarpath)
+                            if not os.path.isdir(path):
+                                extract_tar_subpath(tarpath, chart['subpath'], path)
             except Exception as e:
-                print('Error: %s' % e)
+                self._chart_print(chart, 'Error: %s' % e)
                 return False
-            path = TEMP_APP_DIR + chart['_tarArcname'] + '/' + chart['subpath']
         elif chart['_pathType'] == 'dir':
             path = chart['path']
 
         # update chart path
         # remove ending '/'
         chart['path'] = path.rstrip('/')
+
+        # reuse the tarball packaged by a previous run if the chart is unchanged
+        cache_key = None
+        if self._chart_cache:
+            try:
+                cache_key = self._chart_cache.key(chart['path'], \
+                        'reproducible:%d' % reproducible_mtime() if self._reproducible else '')
+            except Exception:
+                # let helm lint report the broken chart
+                cache_key = None
+        if cache_key:
+            tarball = self._chart_cache.get(cache_key, self._flux_manifest['outputChartDir'])
+            record('cache_hits' if tarball else 'cache_misses')
+            if tarball:
+                chart['tarballName'] = tarball
+                self._chart_print(chart, 'Using cached tarball %s\n' % tarball)
+                return True
+
         # lint and package
         ret = self._package_helm_chart(chart)
+        if ret and 'tarballName' in chart:
+            record('written', os.path.getsize(self._flux_manifest['outputChartDir'] + chart['tarballName']))
+        if ret and self._reproducible and 'tarballName' in chart:
+            normalize_tarball(self._flux_manifest['outputChartDir'] + chart['tarballName'], reproducible_mtime())
+        if ret and cache_key and 'tarballName' in chart:
+            self._chart_cache.put(cache_key, self._flux_manifest['outputChartDir'] + chart['tarballName'])
 
         return ret
 
 
+    # Worker of the helm chart packaging pool
+    # the first failing chart stops all the other workers
+    #
+    def _gen_helm_chart_worker(self, chart, parent_span=None):
+        if self._abort.is_set():
+            return False
+        try:
+            with self._span('chart ' + chart['name'], 'chart', parent_span):
+                ret = self._gen_helm_chart_tarball(chart)
+        except Exception as e:
+            self._chart_print(chart, 'Error: %s' % e)
+            ret = False
+        if not ret and not self._abort.is_set():
+            chart['_failed'] = True
+            self._abort_helm_charts()
+        return ret
+
+
+    # Sub-process of app generation
+    # fetch, lint and package every helm chart with up to self._jobs workers
+    #
+    def _gen_helm_chart_tarballs(self):
+        from concurrent.futures import ThreadPoolExecutor
+        charts = self._flux_chart
+        self._abort.clear()
+        for chart in charts:
+            chart['_log'] = []
+            chart['_failed'] = False
+
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = [executor.submit(self._gen_helm_chart_worker, chart, current_span()) for chart in charts]
+            # print the charts log in the manifest order as they finish
+            for chart, future in zip(charts, futures):
+                if not future.result():
+                    for pending in futures:
+                        pending.cancel()
+                    break
+                for msg in chart['_log']:
+                    print(msg)
+                print('Helm chart %s tarball generated!' % chart['name'])
+                print('')
+
+        failed = [chart for chart in charts if chart['_failed']]
+        for chart in failed:
+            for msg in chart['_log']:
+                print(msg)
+            print('Generating tarball for helm chart: %s error!' % chart['name'])
+        return not failed
+
+
+    # Remove the chart tarballs of a previous run that are no longer produced,
+    # e.g. the ones of a chart whose version changed, so that they are not
+    # part of the checksum and app tarball
+    #
+    def _remove_stale_chart_tarballs(self):
+        tarballs = {chart.get('tarballName') for chart in self._flux_chart}
+        if None in tarballs:
+            return
+        for filename in os.listdir(self._flux_manifest['outputChartDir']):
+            if filename.endswith('.tgz') and filename not in tarballs:
+                os.remove(self._flux_manifest['outputChartDir'] + filename)
+
+
 
     # pyyaml does not support writing yaml block with initial indent
     # add initial indent for yaml block substitution
     def _write_yaml_to_manifest(self, key, src, init_indent):
+        if isinstance(src, list) and src and all(isinstance(item, str) for item in src):
+            return yaml_list_block(tuple(src), init_indent)
         target = {}
         # add heading key
         target[key] = src
-        lines = yaml.safe_dump(target).split('\n')
+        lines = yaml_dump(target).split('\n')
         # remove ending space ans first line
         lines.pop()
         lines.pop(0)
@@ -195,45 +1424,6 @@ class FluxApplication:
         return '\n'.join(lines) + '\n'
 
 
-    def _substitute_values(self, in_line, dicts):
-        out_line = in_line
-        pattern = re.compile('\$.+?\$')
-        results = pattern.findall(out_line)
-        if results:
-            for result in results:
-                result_word = result.strip('$').split('%')
-                value_key = result_word[0]
-                value_default = ''
-                if len(result_word) > 1:
-                    value_default = result_word[1]
-                # underscore case to camel case
-                value = to_camel_case(value_key)
-                if value in dicts:
-                    out_line = out_line.replace(result, str(dicts[value]))
-                elif value_default:
-                    out_line = out_line.replace(result, value_default)
-
-        if out_line == in_line:
-            return out_line, False
-        else:
-            return out_line, True
-
-
-    def _substitute_blocks(self, in_line, dicts):
-        out_line = in_line
-        result = re.search('@\S+\|\d+@',out_line)
-        if result:
-            block_key = result.group().strip('@').split('|')
-            key = block_key[0].lower()
-            indent = int(block_key[1])
-            if key in dicts:
-                out_line = self._write_yaml_to_manifest(key, dicts[key], indent)
-            else:
-                out_line = ''
-
-        return out_line
-
-
     # Sub-process of app generation
     # generate application fluxcd manifest files
     #
@@ -241,84 +1431,34 @@ class FluxApplication:
         # check manifest file existance
         flux_dir = self._flux_manifest['outputFluxDir']
 
-        # update schema path to abspath
-        kustomization_template = APP_GEN_PY_PATH + '/' + SCHEMA_KUSTOMIZATION_TEMPLATE
-        
-        base_helmrepo_template = APP_GEN_PY_PATH + '/' + SCHEMA_BASE_TEMPLATES + '/helmrepository.template'
-        base_kustom_template = APP_GEN_PY_PATH + '/' + SCHEMA_BASE_TEMPLATES + '/kustomization.template'
-        base_namespace_template = APP_GEN_PY_PATH + '/' + SCHEMA_BASE_TEMPLATES + '/namespace.template'
-
-        manifest_helmrelease_template = APP_GEN_PY_PATH + '/' + SCHEMA_MANIFEST_TEMPLATE + '/helmrelease.template'
-        manifest_kustomization_template = APP_GEN_PY_PATH + '/' + SCHEMA_MANIFEST_TEMPLATE + '/kustomization.template'
+        templates = self._templates
+        kustomization_plan = templates.plan(SCHEMA_KUSTOMIZATION_TEMPLATE)
+        base_namespace_plan = templates.plan(SCHEMA_BASE_NAMESPACE_TEMPLATE)
+        manifest_helmrelease_plan = templates.plan(SCHEMA_MANIFEST_HELMRELEASE_TEMPLATE)
+        manifest_kustomization_plan = templates.plan(SCHEMA_MANIFEST_KUSTOMIZATION_TEMPLATE)
 
         manifest = self._flux_manifest
         chartgroup = self._flux_chart_group
         chart = self._flux_chart
 
         # generate kustomization file
-        try:
-            with open(kustomization_template, 'r') as f:
-                kustomization_schema = f.readlines()
-        except IOError:
-            print('File %s not found' % kustomization_template)
-            return False
         kustom_file = flux_dir + 'kustomization.yaml'
-        with open(kustom_file, 'a') as f:
-            # substitute values
-            for line in kustomization_schema:
-                # substitute template values to manifest values
-                out_line, substituted = self._substitute_values(line, chartgroup)
-                if not substituted:
-                    # substitute template blocks to manifest blocks
-                    out_line = self._substitute_blocks(line, chartgroup)
-                f.write(out_line)
+        self._stager.add(kustom_file, kustomization_plan.render(chartgroup, self._write_yaml_to_manifest))
 
 
         # generate base/namespace file
-        try:
-            with open(base_namespace_template, 'r') as f:
-                base_namespace_schema = f.readlines()
-        except IOError:
-            print('File %s not found' % base_namespace_template)
-            return False
         base_namespace_file = flux_dir + 'base/namespace.yaml'
-        with open(base_namespace_file, 'a') as f:
-            # substitute values
-            for line in base_namespace_schema:
-                # substitute template values to manifest values
-                out_line, substituted = self._substitute_values(line, manifest)
-                if not substituted:
-                    # substitute template blocks to manifest blocks
-                    out_line = self._substitute_blocks(line, manifest)
-                f.write(out_line)
+        self._stager.add(base_namespace_file, base_namespace_plan.render(manifest, self._write_yaml_to_manifest))
 
 
         # generate base/kustomization file
         # generate base/helmrepository file
         # Both yaml files don't need to add informations from the input file
-        try:
-            with open(base_kustom_template, 'r') as f:
-                base_kustom_schema = f.readlines()
-        except IOError:
-            print('File %s not found' % base_kustom_template)
-            return False
         base_kustom_file = flux_dir + 'base/kustomization.yaml'
-        with open(base_kustom_file, 'a') as f:
-            for line in base_kustom_schema:
-                out_line = line
-                f.write(out_line)
+        self._stager.add(base_kustom_file, templates.text(SCHEMA_BASE_KUSTOMIZATION_TEMPLATE))
 
-        try:
-            with open(base_helmrepo_template, 'r') as f:
-                base_helmrepo_schema = f.readlines()
-        except IOError:
-            print('File %s not found' % base_helmrepo_template)
-            return False
         base_helmrepo_file = flux_dir + 'base/helmrepository.yaml'
-        with open(base_helmrepo_file, 'a') as f:
-            for line in base_helmrepo_schema:
-                out_line = line
-                f.write(out_line)
+        self._stager.add(base_helmrepo_file, templates.text(SCHEMA_BASE_HELMREPO_TEMPLATE))
 
 
         # iterate each fluxcd_chart for the generation of its fluxcd manifests
@@ -326,51 +1466,23 @@ class FluxApplication:
             a_chart = chart[idx]
 
             # generate manifest/helmrelease file
-            try:
-                with open(manifest_helmrelease_template, 'r') as f:
-                    manifest_helmrelease_schema = f.readlines()
-            except IOError:
-                print('File %s not found' % manifest_helmrelease_template)
-                return False
             manifest_helmrelease_file = flux_dir + a_chart['name'] + '/helmrelease.yaml'
-            with open(manifest_helmrelease_file, 'a') as f:
-                # fetch chart specific info
-                for line in manifest_helmrelease_schema:
-                    # substitute template values to chart values
-                    out_line, substituted = self._substitute_values(line, a_chart)
-                    if not substituted:
-                        # substitute template blocks to chart blocks
-                        out_line = self._substitute_blocks(line, a_chart)
-                    f.write(out_line)
+            self._stager.add(manifest_helmrelease_file, manifest_helmrelease_plan.render(a_chart, self._write_yaml_to_manifest))
 
 
             # generate manifest/kustomizaion file
-            try:
-                with open(manifest_kustomization_template, 'r') as f:
-                    manifest_kustomization_schema = f.readlines()
-            except IOError:
-                print('File %s not found' % manifest_kustomization_template)
-                return False
             manifest_kustomization_file = flux_dir + a_chart['name'] + '/kustomization.yaml'
-            with open(manifest_kustomization_file, 'a') as f:
-                # fetch chart specific info
-                for line in manifest_kustomization_schema:
-                    # substitute template values to chart values
-                    out_line, substituted = self._substitute_values(line, a_chart)
-                    if not substituted:
-                        # substitute template blocks to chart blocks
-                        out_line = self._substitute_blocks(line, a_chart)
-                    f.write(out_line)
+            self._stager.add(manifest_kustomization_file, manifest_kustomization_plan.render(a_chart, self._write_yaml_to_manifest))
 
 
             # generate an empty manifest/system-overrides file
             system_override_file = flux_dir + '/' + a_chart['name'] + '/' + a_chart['name'] + '-system-overrides.yaml'
-            open(system_override_file, 'w').close()
+            self._stager.add(system_override_file)
 
 
             # generate a manifest/static-overrides file
             static_override_file = flux_dir + '/' + a_chart['name'] + '/' + a_chart['name'] + '-static-overrides.yaml'
-            open(static_override_file, 'w').close()
+            self._stager.add(static_override_file)
 
         return True
 
@@ -382,40 +1494,26 @@ class FluxApplication:
 
         plugin_dir =  self._flux_manifest['outputPluginDir']
 
-        common_template = APP_GEN_PY_PATH + '/' + SCHEMA_COMMON_TEMPLATE
-        helm_template = APP_GEN_PY_PATH + '/' + SCHEMA_HELM_TEMPLATE
-        kustomize_template = APP_GEN_PY_PATH + '/' + SCHEMA_KUSTOMIZE_TEMPLATE
-        lifecycle_template = APP_GEN_PY_PATH + '/' + SCHEMA_LIFECYCLE_TEMPLATE
+        templates = self._templates
 
         appname = 'k8sapp_' + self.APP_NAME_WITH_UNDERSCORE
         namespace = self._flux_manifest['namespace']
         name = self._flux_chart[0]['name']
 
         # generate Common files
-        try:
-            with open(common_template, 'r') as f:
-                common_schema = f.read()
-        except IOError:
-            print('File %s not found' % common_template)
-            return False
+        common_schema = templates.text(SCHEMA_COMMON_TEMPLATE)
         common_file = plugin_dir + '/' + appname + '/common/constants.py'
         output = common_schema.format(appname=appname, name=name, namespace=namespace)
 
-        with open(common_file, "w") as f:
-            f.write(output)
+        self._stager.add(common_file, output)
 
         init_file = plugin_dir + '/' + appname + '/common/__init__.py'
-        open(init_file, 'w').close()
+        self._stager.add(init_file)
 
         chart = self._flux_chart
 
         # Generate Helm files
-        try:
-            with open(helm_template, 'r') as f:
-                helm_schema = f.read()
-        except IOError:
-            print('File %s not found' % helm_template)
-            return False
+        helm_schema = templates.text(SCHEMA_HELM_TEMPLATE)
 
         for idx in range(len(chart)):
             a_chart = chart[idx]
@@ -427,183 +1525,295 @@ class FluxApplication:
 
             output = helm_schema.format(appname=appname, name=name)
 
-            with open(helm_file, "w") as f:
-                f.write(output)
+            self._stager.add(helm_file, output)
 
         init_file = plugin_dir + '/' + appname + '/helm/__init__.py'
-        open(init_file, 'w').close()
+        self._stager.add(init_file)
 
         # Generate Kustomize files
-        try:
-            with open(kustomize_template, 'r') as f:
-                kustomize_schema = f.read()
-        except IOError:
-            print('File %s not found' % kustomize_template)
-            return False
+        kustomize_schema = templates.text(SCHEMA_KUSTOMIZE_TEMPLATE)
         kustomize_file = plugin_dir + '/' + appname + '/kustomize/kustomize_' + self.APP_NAME_WITH_UNDERSCORE + '.py'
         output = kustomize_schema.format(appname=appname, appnameStriped=self.APP_NAME_CAMEL_CASE)
 
-        with open(kustomize_file, "w") as f:
-            f.write(output)
+        self._stager.add(kustomize_file, output)
 
         init_file = plugin_dir + '/' + appname + '/kustomize/__init__.py'
-        open(init_file, 'w').close()
+        self._stager.add(init_file)
 
         # Generate Lifecycle files
-        try:
-            with open(lifecycle_template, 'r') as f:
-                lifecycle_schema = f.read()
-        except IOError:
-            print('File %s not found' % lifecycle_template)
-            return False
+        lifecycle_schema = templates.text(SCHEMA_LIFECYCLE_TEMPLATE)
         lifecycle_file = plugin_dir + '/' + appname + '/lifecycle/lifecycle_' + self.APP_NAME_WITH_UNDERSCORE + '.py'
         output = lifecycle_schema.format(appnameStriped=self.APP_NAME_CAMEL_CASE)
 
-        with open(lifecycle_file, "w") as f:
-            f.write(output)
+        self._stager.add(lifecycle_file, output)
 
         init_file = plugin_dir + '/' + appname + '/lifecycle/__init__.py'
-        open(init_file, 'w').close()
+        self._stager.add(init_file)
 
         # Generate setup.py
         setupPy_file = plugin_dir + '/setup.py'
         file = f"""import setuptools\n\nsetuptools.setup(\n    setup_requires=['pbr>=2.0.0'],\n    pbr=True)"""
 
-        with open(setupPy_file, 'w') as f:
-            f.write(file)
+        self._stager.add(setupPy_file, file)
 
         # Generate setup.cfg file
         self.write_app_setup()
 
 
         init_file = plugin_dir + '/__init__.py'
-        open(init_file, 'w').close()
+        self._stager.add(init_file)
 
 
         init_file = plugin_dir + '/' + appname + '/__init__.py'
-        open(init_file, 'w').close()
+        self._stager.add(init_file)
 
         return True
 
 
     def _create_flux_dir(self, output_dir):
 
-        if not os.path.exists(self._flux_manifest['outputChartDir']):
-            os.makedirs(self._flux_manifest['outputChartDir'])
-        if not os.path.exists(self._flux_manifest['outputFluxDir']):
-            os.makedirs(self._flux_manifest['outputFluxBaseDir'])
-            for idx in range(len(self._flux_chart)):
-                chart = self._flux_chart[idx]
-                self._flux_manifest['outputFluxManifestDir'] = output_dir + '/fluxcd-manifests/' + chart['name']
-                os.makedirs(self._flux_manifest['outputFluxManifestDir'])
+        self._stager.add_dir(self._flux_manifest['outputChartDir'])
+        self._stager.add_dir(self._flux_manifest['outputFluxBaseDir'])
+        for idx in range(len(self._flux_chart)):
+            chart = self._flux_chart[idx]
+            self._flux_manifest['outputFluxManifestDir'] = output_dir + '/fluxcd-manifests/' + chart['name']
+            self._stager.add_dir(self._flux_manifest['outputFluxManifestDir'])
 
 
     def _create_plugins_dir(self):
 
-        if not os.path.exists(self._flux_manifest['outputPluginDir']):
-            os.makedirs(self._flux_manifest['outputPluginDir'])
-        if not os.path.exists(self._flux_manifest['outputHelmDir']):
-            os.makedirs(self._flux_manifest['outputHelmDir'])
-        if not os.path.exists(self._flux_manifest['outputCommonDir']):
-            os.makedirs(self._flux_manifest['outputCommonDir'])
-        if not os.path.exists(self._flux_manifest['outputKustomizeDir']):
-            os.makedirs(self._flux_manifest['outputKustomizeDir'])
-        if not os.path.exists(self._flux_manifest['outputLifecycleDir']):
-            os.makedirs(self._flux_manifest['outputLifecycleDir'])
+        self._stager.add_dir(self._flux_manifest['outputPluginDir'])
+        self._stager.add_dir(self._flux_manifest['outputHelmDir'])
+        self._stager.add_dir(self._flux_manifest['outputCommonDir'])
+        self._stager.add_dir(self._flux_manifest['outputKustomizeDir'])
+        self._stager.add_dir(self._flux_manifest['outputLifecycleDir'])
+
+
+    # Files of the application tarball, relative to the output dir
+    #
+    def _list_app_files(self):
+        skip = [BUILD_MANIFEST_FILE, 'checksum.sha256', self._app_tarball_name(), self._app_tarball_name() + '.tmp']
+        app_files = []
+        for parent, dirnames, filenames in os.walk(self._flux_manifest['outputDir']):
+            for filename in filenames:
+                rel_path = os.path.relpath(os.path.join(parent, filename), self._flux_manifest['outputDir'])
+                if filename[-3:] != '.py' and filename[-4:] != '.cfg' and rel_path not in skip:
+                    app_files.append('./' + rel_path)
+        return app_files
+
+
+    # Input files of the plugin wheels, relative to the output dir
+    #
+    def _list_plugin_files(self):
+        plugin_files = []
+        for parent, dirnames, filenames in os.walk(self._flux_manifest['outputPluginDir']):
+            for filename in filenames:
+                if not filename.endswith('.whl'):
+                    plugin_files.append(os.path.relpath(os.path.join(parent, filename), self._flux_manifest['outputDir']))
+        return plugin_files
+
+
+    def _list_plugin_wheels(self):
+        return [f for f in os.listdir(self._flux_manifest['outputPluginDir']) if f.endswith('.whl')]
+
+
+    def _app_tarball_name(self):
+        return self._flux_manifest['appName'] + '-' + self._flux_manifest['appVersion'] + '.tgz'
+
+
+    # Fingerprint of the input files of a stage, by path, size and mtime, and
+    # of the packaging options
+    # files left untouched by an incremental run keep their fingerprint
+    #
+    def _stat_fingerprint(self, rel_paths):
+        import hashlib
+        fingerprint = hashlib.sha256()
+        fingerprint.update(('%s %d %s\n' % (self._compress, self._compress_level, \
+                'reproducible:%d' % reproducible_mtime() if self._reproducible else '')).encode())
+        for rel_path in sorted(rel_paths):
+            st = os.stat(os.path.join(self._flux_manifest['outputDir'], rel_path))
+            fingerprint.update(('%s %d %d\n' % (rel_path, st.st_size, st.st_mtime_ns)).encode())
+        return fingerprint.hexdigest()
+
+
+    def _load_build_manifest(self):
+        self._build_manifest = {'files': {}, 'stages': {}}
+        try:
+            with open(self._flux_manifest['outputDir'] + '/' + BUILD_MANIFEST_FILE) as f:
+                self._build_manifest.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+
+
+    def _save_build_manifest(self):
+        manifest_file = self._flux_manifest['outputDir'] + '/' + BUILD_MANIFEST_FILE
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(self._build_manifest, f, indent=1, sort_keys=True)
+        os.replace(manifest_file + '.tmp', manifest_file)
 
 
     # Sub-process of app generation
     # generate application sha256 file
     #
     def _gen_sha256(self, in_file):
-        with open(in_file, 'rb') as f:
-            out_sha256 = hashlib.sha256(f.read()).hexdigest()
-        return out_sha256
+        return file_sha256(in_file)
 
 
     # Sub-process of app generation
     # generate plugin wheels
+    # The universal wheel is written directly from the plugin package files
+    # and the setup.cfg rendered by write_app_setup (read back from the
+    # plugins dir for --package-only), without running setup.py.
     #
     def _gen_plugin_wheels(self):
+        import configparser
         dirplugins = self._flux_manifest['outputPluginDir']
+        staged = self._stager.files if self._stager else dict()
 
-        store_cwd = os.getcwd()
-        os.chdir(dirplugins)
-
-
-        command = [
-            "python3",
-            "setup.py",
-            "bdist_wheel",
-            "--universal",
-            "-d",
-            dirplugins]
-        
+        setup_cfg = configparser.ConfigParser(delimiters=('=',), interpolation=None)
+        setup_cfg.optionxform = str
         try:
-            subprocess.call(command, stderr=subprocess.STDOUT)
-        except:
+            if 'plugins/setup.cfg' in staged:
+                setup_cfg.read_string(staged['plugins/setup.cfg'])
+            else:
+                with open(dirplugins + '/setup.cfg') as f:
+                    setup_cfg.read_file(f)
+            metadata = setup_cfg['metadata']
+            packages = setup_cfg['files']['packages'].split()
+        except (IOError, KeyError, configparser.Error) as e:
+            print('Error: invalid %s/setup.cfg: %s' % (dirplugins, e))
             return False
 
-        files = [
-            f'{dirplugins}/ChangeLog',
-            f'{dirplugins}/AUTHORS']
-        for file in files:
-            os.remove(file)
-
-        dirs = [
-            f'{dirplugins}/build/',
-            f'{dirplugins}/k8sapp_{self.APP_NAME_WITH_UNDERSCORE}.egg-info/']
-        for dir in dirs:
-            shutil.rmtree(dir)
+        name = metadata['name']
+        version = metadata.get('version') or os.environ.get('PBR_VERSION') or WHEEL_DEFAULT_VERSION
+        dist_name = re.sub('[^A-Za-z0-9.]+', '_', name)
+        dist_info = '%s-%s.dist-info' % (dist_name, version)
+
+        # python files of the plugin packages
+        files = dict()
+        for rel_path, content in staged.items():
+            arcname = os.path.relpath(rel_path, 'plugins')
+            if arcname.split('/')[0] in packages and arcname.endswith('.py'):
+                files[arcname] = content.encode()
+        if not staged:
+            for package in packages:
+                for parent, dirnames, filenames in os.walk(dirplugins + '/' + package):
+                    for filename in filenames:
+                        if filename.endswith('.py'):
+                            path = os.path.join(parent, filename)
+                            with open(path, 'rb') as f:
+                                files[os.path.relpath(path, dirplugins)] = f.read()
+
+        # core metadata
+        out = 'Metadata-Version: 2.1\nName: %s\nVersion: %s\n' % (name, version)
+        for key, field in WHEEL_METADATA_FIELDS.items():
+            if key in metadata:
+                for value in metadata[key].strip().split('\n'):
+                    out += '%s: %s\n' % (field, value.strip())
+        files[dist_info + '/METADATA'] = out.encode()
+
+        files[dist_info + '/WHEEL'] = ('Wheel-Version: 1.0\nGenerator: app-gen\n'
+                'Root-Is-Purelib: true\nTag: py2-none-any\nTag: py3-none-any\n').encode()
 
-        os.chdir(store_cwd)
+        out = ''
+        if setup_cfg.has_section('entry_points'):
+            for group, entries in setup_cfg['entry_points'].items():
+                out += '[%s]\n' % group
+                for entry in entries.strip().split('\n'):
+                    out += entry.strip() + '\n'
+                out += '\n'
+        files[dist_info + '/entry_points.txt'] = out.encode()
+        files[dist_info + '/top_level.txt'] = ''.join(p + '\n' for p in packages).encode()
+
+        for wheel in self._list_plugin_wheels():
+            os.remove(dirplugins + '/' + wheel)
+        date_time = time.localtime()[:6]
+        if self._reproducible:
+            # zip timestamps start in 1980
+            date_time = time.gmtime(max(reproducible_mtime(), 315532800))[:6]
+        try:
+            write_wheel('%s/%s-%s-py2.py3-none-any.whl' % (dirplugins, dist_name, version), \
+                    files, dist_info, date_time)
+        except (IOError, ValueError) as e:
+            print('Error: %s' % e)
+            return False
 
         return True
 
+
     # Sub-process of app generation
     # generate application checksum file and tarball
+    # Every file is hashed while it is copied into the tarball, so that it is
+    # read from disk only once. checksum.sha256 is added last.
     #
     def _gen_checksum_and_app_tarball(self):
-        store_cwd = os.getcwd()
-        os.chdir(self._flux_manifest['outputDir'])
-        # gen checksum
-        # check checksum file existance
+        import tarfile
+        output_dir = self._flux_manifest['outputDir']
         checksum_file = 'checksum.sha256'
-        if os.path.exists(checksum_file):
-            os.remove(checksum_file)
-        app_files = []
-        for parent, dirnames, filenames in os.walk('./'):
-            for filename in filenames:
-                if filename[-3:] != '.py' and filename[-4:] != '.cfg':
-                    app_files.append(os.path.join(parent, filename))
-        with open(checksum_file, 'a') as f:
-            for target_file in sorted(app_files):
-                f.write(self._gen_sha256(target_file) + ' ' + target_file + '\n')
-        app_files.append('./' + checksum_file)
+        app_files = sorted(self._list_app_files())
+        app_sha256 = []
 
         # gen application tarball
-        tarname = self._flux_manifest['appName'] + '-' + self._flux_manifest['appVersion'] + '.tgz'
-        t = tarfile.open(tarname, 'w:gz')
-        for target_file in app_files:
-            t.add(target_file)
-        t.close()
-        os.chdir(store_cwd)
+        tarname = self._app_tarball_name()
+        # a failed or interrupted write leaves no partial tarball behind
+        try:
+            with open(output_dir + '/' + tarname + '.tmp', 'wb') as raw, \
+                    self._open_compressor(tarname, raw) as compressed, \
+                    tarfile.open(fileobj=compressed, mode='w') as t:
+                for target_file in app_files:
+                    path = os.path.join(output_dir, target_file)
+                    tarinfo = t.gettarinfo(path, arcname=target_file)
+                    if self._reproducible:
+                        normalize_tarinfo(tarinfo, reproducible_mtime())
+                    if not tarinfo.isreg():
+                        t.addfile(tarinfo)
+                        app_sha256.append(self._gen_sha256(path))
+                        continue
+                    with open(path, 'rb') as f:
+                        reader = HashingReader(f)
+                        t.addfile(tarinfo, reader)
+                    record('read', tarinfo.size)
+                    app_sha256.append(reader.hexdigest())
+
+                # gen checksum
+                with open(output_dir + '/' + checksum_file, 'w') as f:
+                    for target_file, target_sha256 in zip(app_files, app_sha256):
+                        f.write(target_sha256 + ' ' + target_file + '\n')
+                tarinfo = t.gettarinfo(output_dir + '/' + checksum_file, arcname='./' + checksum_file)
+                if self._reproducible:
+                    normalize_tarinfo(tarinfo, reproducible_mtime())
+                with open(output_dir + '/' + checksum_file, 'rb') as f:
+                    t.addfile(tarinfo, f)
+        except BaseException:
+            if os.path.exists(output_dir + '/' + tarname + '.tmp'):
+                os.remove(output_dir + '/' + tarname + '.tmp')
+            raise
+        os.replace(output_dir + '/' + tarname + '.tmp', output_dir + '/' + tarname)
+        record('written', os.path.getsize(output_dir + '/' + tarname))
+        if self._reproducible:
+            print('App tarball sha256: %s' % file_sha256(output_dir + '/' + tarname))
         return tarname
-    
 
-    # Function to call all process fot the creation of the app tarball
-    # 1 - Validate input file and helm chart data
-    # 2 - Create application directories
-    # 3 - Generate FluxCD Manifests
-    # 4 - Generate application plugins
-    # 5 - Generate application metadata
-    # 6 - Package helm-charts
-    # 7 - Package plugins in wheel format
-    # 8 - Generate checksum
-    # 9 - Package entire application
-    def gen_app(self, output_dir, overwrite, no_package, package_only):
 
-        
+    # gzip stream of the application tarball
+    # 'gzip' is the zlib single thread stream, 'pgzip' compresses blocks in
+    # parallel and 'store' does not compress at all. All of them are standard
+    # gzip streams, readable by StarlingX.
+    #
+    # A reproducible tarball has no name and mtime in its gzip header.
+    #
+    def _open_compressor(self, tarname, raw):
+        import gzip
+        mtime = 0 if self._reproducible else None
+        if self._compress == 'pgzip':
+            return ParallelGzipWriter(raw, self._compress_level, mtime=mtime)
+        level = 0 if self._compress == 'store' else self._compress_level
+        return gzip.GzipFile('' if self._reproducible else tarname, 'wb', level, raw, mtime)
+
+
+    # Set the output dirs of the application files
+    #
+    def _set_output_dir(self, output_dir):
         self._flux_manifest['outputDir'] = output_dir
         self._flux_manifest['outputChartDir'] = output_dir + '/charts/'
         self._flux_manifest['outputFluxDir'] = output_dir + '/fluxcd-manifests/'
@@ -616,80 +1826,166 @@ class FluxApplication:
         self._flux_manifest['outputKustomizeDir'] = output_dir + '/plugins/k8sapp_' + self._flux_manifest['appName'].replace(" ", "_").replace("-", "_") + '/kustomize/'
         self._flux_manifest['outputLifecycleDir'] = output_dir + '/plugins/k8sapp_' + self._flux_manifest['appName'].replace(" ", "_").replace("-", "_") + '/lifecycle/'
 
-        # 1 - Validate input file and helm chart data
-        self.check_charts()
+
+    # Function to call all process fot the creation of the app tarball
+    # 1 - Fetch the git and tarball helm charts, in the background
+    # 2 - Create application directories
+    # 3 - Generate FluxCD Manifests
+    # 4 - Generate application plugins
+    # 5 - Generate application metadata
+    # 6 - Validate input file and helm chart data
+    # 7 - Package helm-charts
+    # 8 - Package plugins in wheel format
+    # 9 - Generate checksum
+    # 10 - Package entire application
+    def gen_app(self, output_dir, overwrite, no_package, package_only, jobs=1, chart_cache=None,
+                incremental=False, compress='gzip', compress_level=9, reproducible=False, timings=None):
+
+        self._jobs = jobs
+        self._reproducible = reproducible
+        self._compress = compress
+        self._compress_level = compress_level
+        self._chart_cache = chart_cache
+        self._timings = timings
+        self._set_output_dir(output_dir)
+
+        if not package_only and os.path.exists(output_dir) and not overwrite and not incremental:
+            print('Output folder %s exists, please remove it or use --overwrite.' % output_dir)
+            return False
+
+        # 1 - Fetch the git and tarball helm charts, in the background
+        # the network latency is hidden behind the rendering
+        self._start_prefetch(no_package)
+
+        # an incremental run reuses the output of the previous one
+        self._build_manifest = {'files': {}, 'stages': {}}
+        if incremental:
+            self._load_build_manifest()
       
         if not package_only:
 
             
-            # 2 - Create application directories
-            if not os.path.exists(self._flux_manifest['outputDir']):
-                os.makedirs(self._flux_manifest['outputDir'])
-            elif overwrite:
-                shutil.rmtree(self._flux_manifest['outputDir'])
-            else:
-                print('Output folder %s exists, please remove it or use --overwrite.' % self._flux_manifest['outputDir'])
-                sys.exit()
-
-            self._create_flux_dir(output_dir)
-            self._create_plugins_dir()
+            # the fetches are stopped as soon as the rendering failed, so
+            # that none is left running once the fetch entries are released
+            rendered = False
+            try:
+                # 2 - Create application directories
+                # the files are staged and swapped into the output folder at once
+                self._stager = OutputStager(self._flux_manifest['outputDir'])
 
-            # 3 - Generate FluxCD Manifests
-            ret = self._gen_fluxcd_manifest()
-            if ret:
-                print('FluxCD manifest generated!')
-            else:
-                print('FluxCCD manifest generation failed!')
-                return ret
+                self._create_flux_dir(output_dir)
+                self._create_plugins_dir()
 
-            # 4 - Generate application plugins
-            ret = self._gen_plugins()
-            if ret:
-                print('Plugins generated!')
-            else:
-                print('Plugins generation failed!')
-                return ret
+                # 3 - Generate FluxCD Manifests
+                with self._span('fluxcd manifest', profile=True):
+                    ret = self._gen_fluxcd_manifest()
+                if ret:
+                    print('FluxCD manifest generated!')
+                else:
+                    print('FluxCCD manifest generation failed!')
+                    return ret
 
-            # 5 - Generate application metadata
-            ret = self._gen_metadata()
-            if ret:
-                print('Metadata generated!')
-            else:
-                print('Metadata generation failed!')
-                return ret
+                # 4 - Generate application plugins
+                with self._span('plugins', profile=True):
+                    ret = self._gen_plugins()
+                if ret:
+                    print('Plugins generated!')
+                else:
+                    print('Plugins generation failed!')
+                    return ret
 
+                # 5 - Generate application metadata
+                with self._span('metadata', profile=True):
+                    ret = self._gen_metadata()
+                if ret:
+                    print('Metadata generated!')
+                else:
+                    print('Metadata generation failed!')
+                    return ret
+                rendered = True
+            finally:
+                if not rendered:
+                    self._wait_prefetch(abort=True)
+
+        # 6 - Validate input file and helm chart data
+        # every chart is checked before anything is written
+        with self._span('fetch charts'):
+            self._wait_prefetch()
+        with self._span('check charts'):
+            ret = self.check_charts()
+        if not ret:
+            print('Helm charts validation failed!')
+            return ret
 
+        if not package_only:
+            with self._span('write output', profile=True):
+                if incremental and self._build_manifest['files']:
+                    changed = self._stager.commit_incremental(self._build_manifest['files'])
+                    record('cache_hits', len(self._stager.files) - len(changed))
+                    record('cache_misses', len(changed))
+                    print('%d generated files changed' % len(changed))
+                else:
+                    self._stager.commit()
+                if incremental:
+                    self._build_manifest['files'] = self._stager.digests()
+                    self._save_build_manifest()
 
         if not no_package:
 
-            # 6 - Package helm-charts
-            for chart in self._flux_chart:
-                ret = self._gen_helm_chart_tarball(chart)
-                if ret:
-                    print('Helm chart %s tarball generated!' % chart['name'])
+            # 7 - Package helm-charts
+            with self._span('helm charts'):
+                ret = self._gen_helm_chart_tarballs()
+            if not ret:
+                return ret
+            if incremental:
+                self._remove_stale_chart_tarballs()
+
+            # 8 - Package plugins in wheel format
+            # skipped when no plugin file changed since the previous run
+            with self._span('plugin wheels', profile=True):
+                plugin_files = self._list_plugin_files()
+                fingerprint = self._stat_fingerprint(plugin_files)
+                if incremental and self._build_manifest['stages'].get('wheel') == fingerprint \
+                        and self._list_plugin_wheels():
+                    record('cache_hits')
+                    print('Plugin wheels up to date!')
+                else:
+                    ret = self._gen_plugin_wheels()
+                    if ret:
+                        print('Plugin wheels generated!')
+                    else:
+                        print('Plugin wheels generation failed!')
+                        return ret
+                    if incremental:
+                        record('cache_misses')
+                        self._build_manifest['stages']['wheel'] = self._stat_fingerprint(self._list_plugin_files())
+                        self._save_build_manifest()
+
+            # 9 - Generate checksum &&
+            # 10 - Package entire application
+            # skipped when no application file changed since the previous run
+            with self._span('app tarball', profile=True):
+                fingerprint = self._stat_fingerprint(self._list_app_files())
+                if incremental and self._build_manifest['stages'].get('tarball') == fingerprint \
+                        and os.path.exists(self._flux_manifest['outputDir'] + '/' + self._app_tarball_name()):
+                    record('cache_hits')
+                    print('App tarball up to date at %s/%s' % (self._flux_manifest['outputDir'], self._app_tarball_name()))
                     print('')
                 else:
-                    print('Generating tarball for helm chart: %s error!' % chart['name'])
-                    return ret
-
-            # 7 - Package plugins in wheel format
-            ret = self._gen_plugin_wheels()
-            if ret:
-                print('Plugin wheels generated!')
-            else:
-                print('Plugin wheels generation failed!')
-                return ret
+                    ret = self._gen_checksum_and_app_tarball()
+                    if ret:
+                        print('Checksum generated!')
+                        print('App tarball generated at %s/%s' % (self._flux_manifest['outputDir'], ret))
+                        print('')
+                    else:
+                        print('Checksum and App tarball generation failed!')
+                        return ret
+                    if incremental:
+                        record('cache_misses')
+                        self._build_manifest['stages']['tarball'] = fingerprint
+                        self._save_build_manifest()
 
-            # 8 - Generate checksum &&
-            # 9 - Package entire application
-            ret = self._gen_checksum_and_app_tarball()
-            if ret:
-                print('Checksum generated!')
-                print('App tarball generated at %s/%s' % (self._flux_manifest['outputDir'], ret))
-                print('')
-            else:
-                print('Checksum and App tarball generation failed!')
-                return ret
+        return True
 
 
     def _gen_metadata(self):
@@ -701,10 +1997,10 @@ class FluxApplication:
         app_name, app_version = self._flux_manifest['appName'], self._flux_manifest['appVersion']
         file = self._flux_manifest['outputDir'] + '/metadata.yaml'
         try:
-            with open(file, 'w') as f:
-                f.write(f'app_name: {app_name}\napp_version: {app_version}\nhelm_repo: stx-platform\n')
-                if yml_data is not None:
-                    yaml.safe_dump(yml_data, f)
+            out = f'app_name: {app_name}\napp_version: {app_version}\nhelm_repo: stx-platform\n'
+            if yml_data is not None:
+                out += yaml_dump(yml_data)
+            self._stager.add(file, out)
         except:
             return False
         
@@ -761,48 +2057,414 @@ class FluxApplication:
                f'\t{self.APP_NAME} = k8sapp_{self.APP_NAME_WITH_UNDERSCORE}.lifecycle.lifecycle_' \
                f'{self.APP_NAME_WITH_UNDERSCORE}:{self.APP_NAME_CAMEL_CASE}AppLifecycleOperator\n\n'
         out += '[bdist_wheel]\nuniversal = 1'
-        with open(f'./{self.APP_NAME}/plugins/setup.cfg', 'w') as f:
-            f.write(out)
+        self._stager.add(self._flux_manifest['outputPluginDir'] + '/setup.cfg', out)
 
 
+    # Validate the Chart.yaml of every chart against the app manifest
+    # The charts are checked in parallel, dirs in place, tarballs by reading
+    # their Chart.yaml member only and git repos through their sparse
+    # checkout, which the packaging reuses. Every error is reported before
+    # returning. Charts known to be valid from their content hash are not
+    # checked again.
+    #
     def check_charts(self):
+        from concurrent.futures import ThreadPoolExecutor
+
         charts = self._flux_chart
         for chart in charts:
-            manifest_data = dict()
-            chart_file_data = dict()
-            manifest_data['name'], manifest_data['version'] = chart['name'], chart['version']
-            if chart['_pathType'] == 'dir':
-                chart_metadata_f = open(f'{chart["path"]}/Chart.yaml', 'r')
-                chart_file_lines = chart_metadata_f.readlines()
-                chart_file_lines = [l for l in chart_file_lines if l[0] != '#']
-                chart_metadata_f.close()
-                for line in chart_file_lines:
-                    line = line.rstrip('\n')
-                    line_data = line.split()
-                    if not line_data:
+            # keeps the errors of the background fetch
+            chart.setdefault('_log', [])
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            parent_span = current_span()
+            results = list(executor.map(lambda chart: self._check_chart(chart, parent_span), charts))
+
+        valid = True
+        for chart, errors in zip(charts, results):
+            if not errors:
+                continue
+            valid = False
+            for msg in chart['_log']:
+                print(msg)
+            for err in errors:
+                print('Error: chart %s: %s' % (chart['name'], err))
+        return valid
+
+
+    # Check a chart, return its errors
+    #
+    def _check_chart(self, chart, parent_span=None):
+        with self._span('check ' + chart['name'], 'chart', parent_span):
+            source = self._validation_source(chart)
+            if source and _VALIDATION_CACHE.contains(validation_key(source, chart)):
+                return []
+
+            try:
+                data = self._read_chart_yaml(chart)
+            except Exception as e:
+                return [str(e)]
+            if data is None:
+                return ['Chart.yaml not found']
+            import hashlib
+            key = validation_key(source or 'chart.yaml:' + hashlib.sha256(data).hexdigest(), chart)
+            if _VALIDATION_CACHE.contains(key):
+                return []
+            errors = chart_metadata_errors(chart, data)
+            if not errors:
+                _VALIDATION_CACHE.add(key)
+            return errors
+
+
+    # Source of a chart whose content hash is known without fetching it,
+    # None if there is none
+    #
+    def _validation_source(self, chart):
+        if chart['_pathType'] == 'tarball' and chart.get('sha256'):
+            return 'tarball:' + chart['sha256'].lower()
+        if chart['_pathType'] == 'git' and re.fullmatch('[0-9a-f]{40}', str(chart.get('ref', ''))):
+            return 'git:' + str(chart['ref'])
+        return None
+
+
+    # Content of the Chart.yaml of a chart, None if there is none
+    #
+    def _read_chart_yaml(self, chart):
+        subpath = os.path.normpath(chart.get('subpath', '.')).strip('/')
+        if chart['_pathType'] == 'dir':
+            path = chart['path'] + '/Chart.yaml'
+        elif chart['_pathType'] == 'tarball':
+            tarpath = self._fetch_tarball(chart)
+            if not tarpath:
+                raise ValueError('fetch of %s failed' % chart['path'])
+            return read_tar_file(tarpath, os.path.join(subpath, 'Chart.yaml'))
+        else:
+            repo_dir = self._fetch_git_repo(chart)
+            if not repo_dir:
+                raise ValueError('git fetch of %s failed' % chart['path'])
+            path = os.path.join(repo_dir, subpath, 'Chart.yaml')
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+# File object wrapper hashing the bytes read through it
+class HashingReader:
+
+    def __init__(self, fileobj):
+        import hashlib
+        self._fileobj = fileobj
+        self._sha256 = hashlib.sha256()
+
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._sha256.update(data)
+        return data
+
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+
+def file_sha256(path) -> str:
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            record('read', len(chunk))
+    return digest.hexdigest()
+
+
+# Host a chart source is fetched from, None for local paths
+def fetch_host(path):
+    from urllib.parse import urlsplit
+    if '://' in path:
+        return urlsplit(path).hostname or None
+    # scp-like git url, user@host:path
+    match = re.match(r'[^/@]+@([^/:]+):', path)
+    return match.group(1) if match else None
+
+
+# Download url to dest
+# The response is streamed in chunks to dest.part, which is renamed to dest
+# only once complete and matching the expected sha256. A .part file left by
+# an interrupted download is resumed with an HTTP range request.
+def download_file(url, dest, sha256=None):
+    import hashlib
+    from urllib import request, error
+    part = dest + '.part'
+    digest = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part):
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                offset += len(chunk)
+
+    req = request.Request(url)
+    if offset:
+        req.add_header('Range', 'bytes=%d-' % offset)
+    try:
+        # a stalled connection raises a timeout, retried as any network error
+        res = request.urlopen(req, timeout=PREFETCH_TIMEOUT)
+    except error.HTTPError as e:
+        if not offset or e.code != 416:
+            raise
+        # the partial file does not match the remote one, start over
+        os.remove(part)
+        return download_file(url, dest, sha256)
+
+    with res:
+        mode = 'ab'
+        if offset and res.getcode() != 206:
+            # range requests not supported, start over
+            digest = hashlib.sha256()
+            mode = 'wb'
+        with open(part, mode) as f:
+            # whatever arrived is kept, a stalled download resumes from it
+            for chunk in iter(lambda: res.read1(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+                record('read', len(chunk))
+                record('written', len(chunk))
+
+    if sha256 and digest.hexdigest() != sha256.lower():
+        os.remove(part)
+        raise ValueError('sha256 of %s is %s, expected %s' % (url, digest.hexdigest(), sha256))
+    os.replace(part, dest)
+
+
+# Whether path, normalized and relative, stays inside the dir it is relative to
+def inside_path(path) -> bool:
+    return not os.path.isabs(path) and path != '..' and not path.startswith('../')
+
+
+# Extract the members of tarpath under <arcname>/<subpath> to dest
+# The archive is decompressed once, as a stream, and only the members that
+# may be part of the chart subpath are written to disk, each one once.
+# Archives without a top level arcname, i.e. with subpath at their root, are
+# supported as well: <arcname>/<subpath> is used when one top level dir holds
+# subpath (for subpath '.', when the archive has a single top level dir),
+# <subpath> otherwise. Members and symlinks pointing outside of the chart are
+# skipped.
+def extract_tar_subpath(tarpath, subpath, dest):
+    import tarfile
+    subpath = os.path.normpath(subpath).lstrip('/')
+    tmp_dir = '%s.tmp-%d-%d' % (dest, os.getpid(), threading.get_ident())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    tmp_root = os.path.realpath(tmp_dir)
+    record('read', os.path.getsize(tarpath))
+
+    def in_subpath(rel_name):
+        return subpath == '.' or rel_name == subpath or rel_name.startswith(subpath + '/')
+
+    try:
+        tops = set()
+        with tarfile.open(tarpath, 'r|gz') as chart_tar:
+            for member in chart_tar:
+                name = os.path.normpath(member.name)
+                if not inside_path(name) or name == '.':
+                    continue
+                tops.add(name.split('/')[0])
+                # the member may be either <arcname>/<subpath>/... or <subpath>/...
+                if not in_subpath(name) and not ('/' in name and in_subpath(name.split('/', 1)[1])):
+                    continue
+                target = os.path.join(tmp_dir, name)
+                # never write through a symlink of the archive
+                if os.path.realpath(os.path.dirname(target)) != os.path.join(tmp_root, os.path.dirname(name)).rstrip('/'):
+                    continue
+                if os.path.islink(target) or os.path.isfile(target):
+                    os.remove(target)
+                if member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                elif member.isfile():
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with chart_tar.extractfile(member) as src, open(target, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                    record('written', member.size)
+                    os.chmod(target, member.mode & 0o777 | 0o600)
+                elif member.issym():
+                    link = os.path.normpath(os.path.join(os.path.dirname(name), member.linkname))
+                    if os.path.isabs(member.linkname) or not inside_path(link):
                         continue
-                    if 'name:' in line_data[0]:
-                        chart_file_data['name'] = line_data[-1]
-                    elif 'version:' in line_data[0]:
-                        chart_file_data['version'] = line_data[-1]
-            # To-do chart type different from dir
-            for key in manifest_data:
-                err_str = ''
-                if key not in chart_file_data:
-                    err_str = f'{key} is present in app-manifest.yaml but not in {chart["path"]}/Chart.yaml'
-                    print(manifest_data[key], chart_file_data[key])
-                    raise KeyError(err_str)
-                if manifest_data[key] != chart_file_data[key]:
-                    err_str = f'{key} has different values in app-manifest.yaml and {chart["path"]}/Chart.yaml'
-                    print(manifest_data[key], chart_file_data[key])
-                    raise ValueError(err_str)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.symlink(member.linkname, target)
+
+        if subpath == '.':
+            arcnames = [top for top in tops if len(tops) == 1 and os.path.isdir(os.path.join(tmp_dir, top))]
+        else:
+            arcnames = [top for top in tops if os.path.isdir(os.path.join(tmp_dir, top, subpath))]
+        if len(arcnames) == 1:
+            chart_dir = os.path.normpath(os.path.join(tmp_dir, arcnames[0], subpath))
+        elif os.path.isdir(os.path.join(tmp_dir, subpath)):
+            chart_dir = os.path.normpath(os.path.join(tmp_dir, subpath))
+        else:
+            raise FileNotFoundError('%s not found in %s' % (subpath, tarpath))
+
+        # symlinks are only followed inside the chart
+        for parent, dirnames, filenames in os.walk(chart_dir):
+            for link_name in dirnames + filenames:
+                link_path = os.path.join(parent, link_name)
+                if os.path.islink(link_path):
+                    target = os.path.relpath(os.path.join(parent, os.readlink(link_path)), chart_dir)
+                    if not inside_path(os.path.normpath(target)):
+                        os.remove(link_path)
+
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.rename(chart_dir, dest)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# Content of the file rel_path of tarpath, None if there is none
+# As for extract_tar_subpath, rel_path may be under a top level arcname or
+# at the root of the archive, <arcname>/<rel_path> being used when a single
+# top level dir holds it (for a file at the chart root, when the archive has
+# a single top level dir). Nothing is written to disk.
+def read_tar_file(tarpath, rel_path):
+    import tarfile
+    rel_path = os.path.normpath(rel_path).lstrip('/')
+    found = dict()
+    tops = set()
+    with tarfile.open(tarpath, 'r|gz') as chart_tar:
+        for member in chart_tar:
+            name = os.path.normpath(member.name)
+            if not inside_path(name) or name == '.':
+                continue
+            tops.add(name.split('/')[0])
+            if not member.isfile():
+                continue
+            if name == rel_path or '/' in name and name.split('/', 1)[1] == rel_path:
+                with chart_tar.extractfile(member) as f:
+                    found[name] = f.read()
+    arcnames = [name for name in found if name != rel_path]
+    if '/' not in rel_path and len(tops) > 1:
+        arcnames = []
+    if len(arcnames) == 1:
+        return found[arcnames[0]]
+    return found.get(rel_path)
+
+
+# Fixed mtime of the reproducible tarballs, SOURCE_DATE_EPOCH if set
+def reproducible_mtime() -> int:
+    return int(os.environ.get('SOURCE_DATE_EPOCH', '0'))
+
+
+# Reset the mtime, owner and mode of a tar member for reproducible tarballs
+def normalize_tarinfo(tarinfo, mtime):
+    tarinfo.mtime = mtime
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    if tarinfo.isdir() or tarinfo.mode & 0o111:
+        tarinfo.mode = 0o755
+    else:
+        tarinfo.mode = 0o644
+    return tarinfo
+
+
+# Rewrite a gzip tarball with sorted and normalized members and a gzip
+# header without name and mtime, e.g. the charts packaged by helm
+def normalize_tarball(path, mtime):
+    import gzip
+    import tarfile
+    with tarfile.open(path, 'r:gz') as src, open(path + '.tmp', 'wb') as raw, \
+            gzip.GzipFile('', 'wb', 9, raw, mtime=0) as compressed, \
+            tarfile.open(fileobj=compressed, mode='w') as dst:
+        for member in sorted(src.getmembers(), key=lambda m: m.name):
+            fileobj = src.extractfile(member) if member.isreg() else None
+            dst.addfile(normalize_tarinfo(member, mtime), fileobj)
+    os.replace(path + '.tmp', path)
+
+
+# Write a wheel with its RECORD from the files content, by archive name
+def write_wheel(path, files, dist_info, date_time):
+    import hashlib
+    import zipfile
+    record_name = dist_info + '/RECORD'
+    lines = []
+    with zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as whl:
+        for arcname in sorted(files, key=lambda n: (n.startswith(dist_info), n)):
+            data = files[arcname]
+            info = zipfile.ZipInfo(arcname, date_time)
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            whl.writestr(info, data)
+            digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b'=').decode()
+            lines.append('%s,sha256=%s,%d\n' % (arcname, digest, len(data)))
+        lines.append(record_name + ',,\n')
+        info = zipfile.ZipInfo(record_name, date_time)
+        info.external_attr = 0o644 << 16
+        info.compress_type = zipfile.ZIP_DEFLATED
+        whl.writestr(info, ''.join(lines))
+    os.replace(path + '.tmp', path)
+    record('written', os.path.getsize(path))
+
+
+class ValidationCache:
+    """
+    keys of the charts found valid.
+
+    A key hashes the chart content (its Chart.yaml, tarball sha256 or git
+    commit) with the manifest values it was checked against. Keys are kept
+    in memory and as empty files in cache_dir, to be shared with later runs.
+    """
+
+    def __init__(self, cache_dir=VALIDATION_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._keys = set()
+
+
+    def contains(self, key):
+        if key in self._keys or os.path.exists(os.path.join(self.cache_dir, key)):
+            self._keys.add(key)
+            return True
+        return False
+
+
+    def add(self, key):
+        self._keys.add(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            open(os.path.join(self.cache_dir, key), 'w').close()
+        except OSError:
+            # the in memory cache is enough for this run
+            pass
+
+
+_VALIDATION_CACHE = ValidationCache()
+
+def validation_key(source, chart) -> str:
+    import hashlib
+    subpath = os.path.normpath(chart.get('subpath', '.')).strip('/')
+    return hashlib.sha256(('%s\n%s\n%s\n%s' % (source, subpath, chart['name'], chart['version'])).encode()).hexdigest()
+
+
+# Errors of a Chart.yaml content against the chart of the app manifest
+def chart_metadata_errors(chart, data) -> list:
+    try:
+        metadata = yaml_load(data)
+    except Exception as e:
+        return ['invalid Chart.yaml: %s' % str(e).replace('\n', ' ')]
+    if not isinstance(metadata, dict):
+        return ['Chart.yaml is not a yaml mapping']
+    errors = []
+    for key in ('name', 'version'):
+        if key not in metadata:
+            errors.append('%s is present in app-manifest.yaml but not in Chart.yaml' % key)
+        elif str(metadata[key]) != str(chart[key]):
+            errors.append('%s has different values in app-manifest.yaml (%s) and Chart.yaml (%s)' \
+                    % (key, chart[key], metadata[key]))
+    return errors
 
 
 def parse_yaml(yaml_in) -> dict:
     yaml_data=dict()
     try:
-        with open(yaml_in) as f:
-            yaml_data = yaml.safe_load(f)
+        yaml_data = load_yaml_file(yaml_in)
     except IOError:
         print('Error: %s no found' % yaml_in )
     except Exception as e:
@@ -810,25 +2472,35 @@ def parse_yaml(yaml_in) -> dict:
     return yaml_data
 
 
+# Check the charts of the app manifest and set their path type
+# every invalid chart is reported, not only the first one
 def check_manifest(manifest_data):
+    valid = True
 
     for chart in manifest_data['appManifestFile-config']['chart']:
         
         # check chart name
         if 'name' not in chart:
             print('Error: Chart attribute \'name\' is missing.')
-            return False
+            valid = False
+            continue
+
+        if 'version' not in chart:
+            print('Error: Chart attribute \'version\' is missing in chart %s.' % chart['name'])
+            valid = False
 
         # check chart path, supporting: dir, git, tarball
         if 'path' not in chart:
             print('Error: Chart attribute \'path\' is missing in chart %s.' % chart['name'])
-            return False
+            valid = False
+            continue
         else:
-            # TODO: To support branches/tags in git repo
+            # git charts may be pinned to a branch, tag or commit with 'ref'
             if chart['path'].endswith('.git'):
                 if 'subpath' not in chart:
                     print('Error: Chart attribute \'subpath\' is missing in chart %s.' % chart['name'])
-                    return False
+                    valid = False
+                    continue
                 chart['_pathType'] = 'git'
                 gitname = re.search('[^/]+(?=\.git$)',chart['path']).group()
                 if gitname:
@@ -836,11 +2508,12 @@ def check_manifest(manifest_data):
                 else:
                     print('Error: Invalid \'path\' in chart %s.' % chart['name'])
                     print('       only \'local dir\', \'.git\', \'.tar.gz\', \'.tgz\' are supported')
-                    return False
+                    valid = False
             elif chart['path'].endswith('.tar.gz') or chart['path'].endswith('.tgz'):
                 if 'subpath' not in chart:
                     print('Error: Chart attribute \'subpath\' is missing in chart %s.' % chart['name'])
-                    return False
+                    valid = False
+                    continue
                 chart['_pathType'] = 'tarball'
                 tarname = re.search('[^/]+(?=\.tgz)|[^/]+(?=\.tar\.gz)',chart['path']).group()
                 if tarname:
@@ -848,40 +2521,450 @@ def check_manifest(manifest_data):
                 else:
                     print('Error: Invalid \'path\' in chart %s.' % chart['name'])
                     print('       only \'local dir\', \'.git\', \'.tar.gz\', \'.tgz\' are supported')
-                    return False
+                    valid = False
+                if 'sha256' in chart and not re.fullmatch('[0-9a-fA-F]{64}', str(chart['sha256'])):
+                    print('Error: Invalid \'sha256\' in chart %s.' % chart['name'])
+                    valid = False
             else:
                 if not os.path.isdir(chart['path']):
                     print('Error: Invalid \'path\' in chart %s.' % chart['name'])
                     print('       only \'local dir\', \'.git\', \'.tar.gz\', \'.tgz\' are supported')
-                    return False
+                    valid = False
+                    continue
                 chart['_pathType'] = 'dir'
 
-    return True
+    return valid
 
 
-def generate_app(file_in, out_folder, overwrite, no_package, package_only):
-    global TEMP_APP_DIR
-    app_data = parse_yaml(file_in)
+def generate_app(file_in, out_folder, overwrite, no_package, package_only, jobs=1, chart_cache=None,
+                 incremental=False, compress='gzip', compress_level=9, reproducible=False,
+                 timings=None) -> bool:
+    with timings.span('parse manifest') if timings else contextlib.nullcontext():
+        app_data = parse_yaml(file_in)
     if not app_data:
         print('Parse yaml error')
-        return
-    if not check_manifest(app_data):
-        print('Application manifest is not valid')
-        return
-    flux_manifest = FluxApplication(app_data)
+        return False
+    return generate_app_data(app_data, out_folder, overwrite, no_package, package_only, jobs, chart_cache,
+                             incremental, compress, compress_level, reproducible, timings)
+
+
+# Generate the app of a parsed app manifest
+def generate_app_data(app_data, out_folder, overwrite, no_package, package_only, jobs=1, chart_cache=None,
+                      incremental=False, compress='gzip', compress_level=9, reproducible=False,
+                      timings=None) -> bool:
+    with timings.span('check manifest') if timings else contextlib.nullcontext():
+        if not check_manifest(app_data):
+            print('Application manifest is not valid')
+            return False
+    templates = load_templates()
+    if not templates:
+        print('Application templates are missing')
+        return False
+    flux_manifest = FluxApplication(app_data, templates)
     app_out = out_folder + '/' + flux_manifest.get_app_name()
-    flux_manifest.gen_app(app_out, overwrite, no_package, package_only)
+    try:
+        return flux_manifest.gen_app(app_out, overwrite, no_package, package_only, jobs, chart_cache, incremental,
+                                     compress, compress_level, reproducible, timings)
+    finally:
+        flux_manifest.release_fetch_entries()
+
+
+class ThreadOutput:
+    """
+    sys.stdout replacement keeping apart the output of the worker threads.
+
+    A thread that called capture() writes to its own buffer until release(),
+    every other thread writes to the wrapped stream.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+
+    def capture(self):
+        self._local.buffer = io.StringIO()
+
+
+    # Stop capturing, return the captured output
+    def release(self) -> str:
+        buffer = self._local.__dict__.pop('buffer', None)
+        return buffer.getvalue() if buffer else ''
+
+
+    def write(self, data):
+        return getattr(self._local, 'buffer', self._stream).write(data)
+
+
+    def flush(self):
+        getattr(self._local, 'buffer', self._stream).flush()
+
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+# List the application manifests of a batch
+# a directory stands for every .yaml and .yml file in it, anything else is
+# a glob pattern
+def batch_manifests(source) -> list:
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, '*.yaml')) + glob.glob(os.path.join(source, '*.yml'))
+    else:
+        paths = glob.glob(source)
+    return sorted(os.path.abspath(path) for path in paths if os.path.isfile(path))
+
+
+# Generate the applications of several manifests in one process
+# up to batch_jobs applications are generated at a time, sharing the loaded
+# templates, the helm chart cache and the fetched git repos and tarballs.
+# Each application log is printed as a whole once it is done, followed by a
+# summary. Return True if every application was generated.
+def generate_batch(manifests, out_folder, batch_jobs, overwrite, no_package, package_only, jobs=1,
+                   chart_cache=None, incremental=False, compress='gzip', compress_level=9,
+                   reproducible=False, timings=None) -> bool:
+    if not load_templates():
+        print('Application templates are missing')
+        return False
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    output = ThreadOutput(sys.stdout)
+
+    def worker(file_in):
+        output.capture()
+        start = time.perf_counter()
+        try:
+            with timings.span('app ' + os.path.basename(file_in), 'app') if timings else contextlib.nullcontext():
+                ret = generate_app(file_in, out_folder, overwrite, no_package, package_only, jobs, chart_cache,
+                                   incremental, compress, compress_level, reproducible, timings)
+        except Exception as e:
+            print('Error: %s' % e)
+            ret = False
+        return bool(ret), time.perf_counter() - start, output.release()
+
+    results = []
+    start = time.perf_counter()
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=batch_jobs) as executor:
+            futures = [executor.submit(worker, file_in) for file_in in manifests]
+            # print the applications log in the batch order as they finish
+            for file_in, future in zip(manifests, futures):
+                ret, elapsed, log = future.result()
+                print('Application manifest %s:' % file_in)
+                print(log)
+                results.append((file_in, ret, elapsed))
+    finally:
+        sys.stdout = output._stream
+    elapsed = time.perf_counter() - start
+
+    print('Batch summary:')
+    for file_in, ret, app_elapsed in results:
+        print('    %-6s %7.1fs  %s' % ('ok' if ret else 'FAILED', app_elapsed, file_in))
+    generated = sum(1 for file_in, ret, app_elapsed in results if ret)
+    print('%d of %d applications generated in %.1fs' % (generated, len(results), elapsed))
+    return generated == len(results)
+
+
+# Files watched by --watch: the app manifest, the templates and the
+# Chart.yaml of the charts in local dirs, with their mtime and size
+def watch_snapshot(file_in) -> dict:
+    paths = [file_in]
+    for template_dir in TemplateRegistry.TEMPLATE_DIRS:
+        for parent, dirnames, filenames in os.walk(os.path.join(APP_GEN_PY_PATH, template_dir)):
+            paths += [os.path.join(parent, filename) for filename in filenames]
+    try:
+        for chart in load_yaml_file(file_in)['appManifestFile-config']['chart']:
+            if os.path.isdir(str(chart.get('path', ''))):
+                paths.append(os.path.join(chart['path'], 'Chart.yaml'))
+    except Exception:
+        # reported by the next generation
+        pass
+
+    snapshot = dict()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            snapshot[path] = None
+    return snapshot
+
+
+# Regenerate the app of file_in whenever a watched file changes
+# The process keeps the parsed manifests, templates and validated charts
+# between generations. Every generation renders in memory and, as with
+# --incremental, rewrites only the files whose content changed. Helm charts,
+# wheels and tarball are not packaged. Runs until interrupted.
+def watch_app(file_in, out_folder, jobs=1, interval=WATCH_INTERVAL):
+    global _TEMPLATES
+    snapshot = None
+    print('Watching %s, press Ctrl-C to stop' % file_in)
+    try:
+        while True:
+            current = watch_snapshot(file_in)
+            if current != snapshot:
+                changed = [path for path in current if not snapshot or current[path] != snapshot.get(path)]
+                if snapshot and any(path.endswith('.template') for path in changed):
+                    _TEMPLATES = None
+                snapshot = current
+                start = time.perf_counter()
+                try:
+                    ret = generate_app(file_in, out_folder, False, True, False, jobs, None, True)
+                except Exception as e:
+                    print('Error: %s' % e)
+                    ret = False
+                print('%s in %.0f ms, waiting for changes...' % ('Generated' if ret else 'Generation failed', \
+                        (time.perf_counter() - start) * 1000))
+                print('')
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+# Parse a --serve address, unix:path or [host:]port on the loopback
+# return (family, address), None if invalid
+def serve_address(value):
+    import socket
+    if value.startswith('unix:'):
+        return socket.AF_UNIX, os.path.abspath(value[len('unix:'):])
+    host, sep, port = value.rpartition(':')
+    host = host.strip('[]') or '127.0.0.1'
+    if not port.isdigit() or host not in SERVE_HOSTS:
+        return None
+    return socket.AF_INET6 if ':' in host else socket.AF_INET, (host, int(port))
+
+
+# Serve app generation requests until interrupted
+# POST /generate with an app manifest as body generates the app under
+# out_folder/request-*/ and answers a json with the output dir, tarball and
+# log, or with ?result=tarball the app tarball itself. ?package=0 only
+# renders the app. GET /health answers ok. Up to jobs requests are handled
+# at a time, sharing the templates, yaml, validation, chart and fetch
+# caches of the process.
+def serve_apps(address, out_folder, jobs, chart_cache=None, compress='gzip', compress_level=9,
+               reproducible=False, app_jobs=1):
+    # http.server pulls in email and http.client, only load it here
+    import http.server
+    import socket
+    import socketserver
+    import stat
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.parse import urlsplit, parse_qs
+
+    family, address = address
+    output = ThreadOutput(sys.stdout)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def address_string(self):
+            return self.client_address[0] if self.client_address else 'unix'
+
+
+        def _reply(self, code, body, content_type='application/json', headers=None):
+            if not isinstance(body, bytes):
+                body = (json.dumps(body, indent=1) + '\n').encode()
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        # Reply 403 to the requests a browser could send on behalf of a web
+        # page: another Host (DNS rebinding) or any cross origin request
+        def _reject(self) -> bool:
+            host = urlsplit('//' + self.headers.get('Host', '')).hostname
+            if host and host not in SERVE_HOSTS:
+                self._reply(403, {'error': 'host %s not allowed' % host})
+                return True
+            if 'Origin' in self.headers:
+                self._reply(403, {'error': 'cross origin requests not allowed'})
+                return True
+            return False
+
+
+        def do_GET(self):
+            if self._reject():
+                return
+            if urlsplit(self.path).path != '/health':
+                return self._reply(404, {'error': 'not found'})
+            self._reply(200, {'status': 'ok'})
+
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            if self._reject():
+                return
+            if url.path != '/generate':
+                return self._reply(404, {'error': 'not found'})
+            # a form or a simple fetch() of a web page can not set it
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type not in SERVE_CONTENT_TYPES:
+                return self._reply(415, {'error': 'Content-Type must be one of %s' % ', '.join(SERVE_CONTENT_TYPES)})
+            no_package = query.get('package', '1') == '0'
+            as_tarball = query.get('result', 'path') == 'tarball'
+            if as_tarball and no_package:
+                return self._reply(400, {'error': 'result=tarball needs package=1'})
+
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > SERVE_MAX_MANIFEST:
+                return self._reply(413, {'error': 'manifest over %d bytes' % SERVE_MAX_MANIFEST})
+            try:
+                app_data = yaml_load(self.rfile.read(length))
+                app_name = app_data['appManifestFile-config']['appName']
+                app_version = app_data['appManifestFile-config']['appVersion']
+            except Exception as e:
+                return self._reply(400, {'error': 'invalid manifest: %s' % str(e).replace('\n', ' ')})
+            # both end up in the paths written
+            for key, value in (('appName', app_name), ('appVersion', app_version)):
+                if not re.fullmatch('[A-Za-z0-9._-]+', str(value)) or '..' in str(value):
+                    return self._reply(400, {'error': 'invalid manifest: %s must only hold A-Z a-z 0-9 . _ - and no ..' % key})
+
+            request_dir = tempfile.mkdtemp(prefix='request-', dir=out_folder)
+            app_out = os.path.join(request_dir, app_name)
+            if os.path.dirname(os.path.realpath(app_out)) != os.path.realpath(request_dir):
+                shutil.rmtree(request_dir, ignore_errors=True)
+                return self._reply(400, {'error': 'invalid manifest: appName %s out of the output folder' % app_name})
+            tarball = os.path.join(app_out, '%s-%s.tgz' % (app_name, app_version))
+            start = time.perf_counter()
+            output.capture()
+            try:
+                ret = generate_app_data(app_data, request_dir, False, no_package, False, app_jobs,
+                                        chart_cache, False, compress, compress_level, reproducible)
+            except Exception as e:
+                print('Error: %s' % e)
+                ret = False
+            finally:
+                log = output.release()
+            elapsed = time.perf_counter() - start
+
+            if not ret:
+                shutil.rmtree(request_dir, ignore_errors=True)
+                return self._reply(422, {'error': 'generation failed', 'log': log})
+            if as_tarball:
+                with open(tarball, 'rb') as f:
+                    data = f.read()
+                shutil.rmtree(request_dir, ignore_errors=True)
+                return self._reply(200, data, 'application/gzip', \
+                        {'Content-Disposition': 'attachment; filename="%s"' % os.path.basename(tarball)})
+            self._reply(200, {'output': app_out, 'tarball': None if no_package else tarball,
+                              'seconds': round(elapsed, 3), 'log': log})
+
+    # requests are handled by a bounded pool instead of a thread each
+    class PoolMixIn:
+
+        def process_request(self, request, client_address):
+            self.executor.submit(self._process_request, request, client_address)
+
+
+        def _process_request(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    class HTTPServer(PoolMixIn, http.server.HTTPServer):
+        address_family = family
+
+    class UnixServer(PoolMixIn, socketserver.UnixStreamServer):
+        pass
+
+    os.makedirs(out_folder, exist_ok=True)
+    if family == socket.AF_UNIX:
+        # a stale socket of a previous run, never a regular file
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)
+        server = UnixServer(address, Handler)
+        os.chmod(address, 0o600)
+        where = 'unix socket %s' % address
+    else:
+        server = HTTPServer(address, Handler)
+        where = 'http://%s:%d' % server.server_address[:2]
+    server.executor = ThreadPoolExecutor(max_workers=jobs)
+
+    print('Serving on %s, output in %s, press Ctrl-C to stop' % (where, out_folder))
+    sys.stdout = output
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout = output._stream
+        server.server_close()
+        server.executor.shutdown()
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+
+
+# app-gen.py gc: evict the least recently used fetch cache entries
+def main_gc(argv):
+    global _FETCH_CACHE
+    max_size = FETCH_CACHE_SIZE
+    try:
+        options, args = getopt.getopt(argv, 'h', ['help', 'fetch-cache=', 'max-size='])
+    except getopt.GetoptError:
+        print('Error: Invalid argument')
+        sys.exit()
+    for option, value in options:
+        if option in ('-h', '--help'):
+            print('Usage:')
+            print('    python app-gen.py gc [Option]')
+            print('')
+            print('Options:')
+            print('        --fetch-cache dir    fetched git repos and tarballs cache (default: %s)' % FETCH_CACHE_DIR)
+            print('        --max-size N         remove the least recently used entries over N MiB (default: %d)' % FETCH_CACHE_SIZE)
+            print('    -h, --help               this help')
+            sys.exit()
+        if option == '--fetch-cache':
+            _FETCH_CACHE = FetchCache(os.path.abspath(value))
+        if option == '--max-size':
+            if not value.isdigit():
+                print('Error: --max-size must be a non negative integer')
+                sys.exit()
+            max_size = int(value)
+
+    removed, freed, kept = _FETCH_CACHE.gc(max_size)
+    print('Removed %d entries (%s) from %s, %s kept' % (removed, format_size(freed), \
+            _FETCH_CACHE.cache_dir, format_size(kept)))
 
 
 def main(argv):
+    global _FETCH_CACHE
+    if argv and argv[0] == 'gc':
+        return main_gc(argv[1:])
+
     input_file = ''
+    batch = ''
+    batch_jobs = BATCH_JOBS
     output_folder = '.'
     overwrite = False
     package_only = False
     no_package = False
+    jobs = 1
+    incremental = False
+    compress = 'gzip'
+    compress_level = 9
+    reproducible = False
+    show_timings = False
+    watch = False
+    serve = None
+    trace_out = ''
+    profile_out = ''
+    chart_cache_dir = CHART_CACHE_DIR
+    chart_cache_size = CHART_CACHE_SIZE
     try:
-        options, args = getopt.getopt(argv, 'hi:o:', \
-                ['help', 'input==', 'output==', 'overwrite', 'no-package', 'package-only'])
+        options, args = getopt.getopt(argv, 'hi:o:j:', \
+                ['help', 'input=', 'batch=', 'batch-jobs=', 'output=', 'overwrite', 'no-package', 'package-only', 'jobs=',
+                 'chart-cache=', 'chart-cache-size=', 'no-chart-cache', 'incremental',
+                 'compress=', 'compress-level=', 'reproducible', 'timings', 'trace-out=', 'profile=', 'watch', 'serve=', 'fetch-cache='])
     except getopt.GetoptError:
         print('Error: Invalid argument')
         sys.exit()
@@ -891,31 +2974,146 @@ def main(argv):
             print('')
             print('Usage:')
             print('    python app-gen.py [Option]')
+            print('    python app-gen.py gc [--fetch-cache dir] [--max-size N]')
             print('')
             print('Options:')
             print('    -i, --input yaml_file    generate app from yaml_file')
             print('    -o, --output folder      generate app to output folder')
+            print('        --batch dir|glob     generate the apps of every yaml file in dir, or matching glob')
+            print('        --batch-jobs N       generate N apps at a time with --batch or --serve (default: %d)' % BATCH_JOBS)
             print('        --overwrite          overwrite the output dir')
             print('        --no-package         does not create app tarball')
             print('        --package-only       only creates tarball from dir')
+            print('    -j, --jobs N             fetch, lint and package N helm charts at a time')
+            print('        --chart-cache dir    packaged helm charts cache (default: %s)' % CHART_CACHE_DIR)
+            print('        --chart-cache-size N max size of the helm charts cache in MiB (default: %d)' % CHART_CACHE_SIZE)
+            print('        --no-chart-cache     always lint and package the helm charts')
+            print('        --fetch-cache dir    fetched git repos and tarballs cache (default: %s)' % FETCH_CACHE_DIR)
+            print('        --incremental        only rewrite the files and rebuild the packages that changed')
+            print('        --compress mode      app tarball compression: gzip, pgzip or store (default: gzip)')
+            print('        --compress-level N   app tarball compression level, 1-9 (default: 9)')
+            print('        --reproducible       byte for byte identical tarballs for identical inputs')
+            print('        --watch              regenerate the changed files when the input, templates or charts change')
+            print('        --serve address      serve generation requests on [host:]port of the loopback or on unix:path')
+            print('        --timings            print the time, subprocess time, I/O and cache hits of each stage')
+            print('        --trace-out file     write the stages timings to file in Chrome trace format')
+            print('        --profile file       write a cProfile of the python stages to file')
             print('    -h, --help               this help')
-        if option in ('--overwrite'):
+        if option == '--overwrite':
             overwrite = True
         if option in ('-i', '--input'):
             input_file = value
         if option in ('-o', '--output'):
             output_folder = value
-        if option in ('--no-package'):
+        if option == '--batch':
+            batch = value
+        if option == '--batch-jobs':
+            if not value.isdigit() or int(value) < 1:
+                print('Error: --batch-jobs must be a positive integer')
+                sys.exit()
+            batch_jobs = int(value)
+        if option == '--no-package':
             no_package = True
-        if option in ('--package-only'):
+        if option == '--package-only':
             package_only = True
+        if option in ('-j', '--jobs'):
+            if not value.isdigit() or int(value) < 1:
+                print('Error: --jobs must be a positive integer')
+                sys.exit()
+            jobs = int(value)
+        if option == '--chart-cache':
+            chart_cache_dir = os.path.abspath(value)
+        if option == '--chart-cache-size':
+            if not value.isdigit():
+                print('Error: --chart-cache-size must be a positive integer')
+                sys.exit()
+            chart_cache_size = int(value)
+        if option == '--no-chart-cache':
+            chart_cache_dir = None
+        if option == '--incremental':
+            incremental = True
+        if option == '--compress':
+            if value not in COMPRESS_MODES:
+                print('Error: --compress must be one of %s' % ', '.join(COMPRESS_MODES))
+                sys.exit()
+            compress = value
+        if option == '--compress-level':
+            if not value.isdigit() or not 1 <= int(value) <= 9:
+                print('Error: --compress-level must be between 1 and 9')
+                sys.exit()
+            compress_level = int(value)
+        if option == '--reproducible':
+            reproducible = True
+        if option == '--watch':
+            watch = True
+        if option == '--fetch-cache':
+            _FETCH_CACHE = FetchCache(os.path.abspath(value))
+        if option == '--serve':
+            serve = serve_address(value)
+            if not serve:
+                print('Error: --serve must be unix:path or [host:]port with host one of %s' % ', '.join(SERVE_HOSTS))
+                sys.exit()
+        if option == '--timings':
+            show_timings = True
+        if option == '--trace-out':
+            trace_out = os.path.abspath(value)
+        if option == '--profile':
+            profile_out = os.path.abspath(value)
 
 
-    if not os.path.isfile(os.path.abspath(input_file)):
+    if batch and input_file:
+        print('Error: --input and --batch are exclusive')
+        sys.exit()
+    if serve and (input_file or batch or watch):
+        print('Error: --serve does not take --input, --batch nor --watch')
+        sys.exit()
+    if watch and (batch or package_only):
+        print('Error: --watch does not support --batch nor --package-only')
+        sys.exit()
+    if batch and profile_out:
+        print('Error: --profile is not supported with --batch')
+        sys.exit()
+    if batch:
+        manifests = batch_manifests(batch)
+        if not manifests:
+            print('Error: no yaml file found for batch %s' % batch)
+            sys.exit()
+    elif not serve and not os.path.isfile(os.path.abspath(input_file)):
         print('Error: input file not found')
         sys.exit()
-    if input_file:
-        generate_app(os.path.abspath(input_file), os.path.abspath(output_folder), overwrite, no_package, package_only)
+    chart_cache = None
+    if chart_cache_dir:
+        chart_cache = ChartCache(chart_cache_dir, chart_cache_size)
+    if serve:
+        serve_apps(serve, os.path.abspath(output_folder), batch_jobs, chart_cache, compress, compress_level,
+                   reproducible, jobs)
+        return
+    if watch:
+        watch_app(os.path.abspath(input_file), os.path.abspath(output_folder), jobs)
+        return
+
+    timings = None
+    if show_timings or trace_out or profile_out:
+        timings = Timings(profile=bool(profile_out))
+    ret = True
+    if batch:
+        ret = generate_batch(manifests, os.path.abspath(output_folder), batch_jobs, overwrite, no_package,
+                             package_only, jobs, chart_cache, incremental, compress, compress_level,
+                             reproducible, timings)
+    elif input_file:
+        ret = generate_app(os.path.abspath(input_file), os.path.abspath(output_folder), overwrite, no_package, package_only, jobs, chart_cache, incremental,
+                           compress, compress_level, reproducible, timings)
+
+    if show_timings:
+        print(timings.table())
+    if trace_out:
+        timings.write_trace(trace_out)
+        print('Trace written to %s' % trace_out)
+    if profile_out:
+        timings.profiler.dump_stats(profile_out)
+        print('Profile written to %s' % profile_out)
+    if not ret:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+"""
+Benchmark of the app-gen.py startup.
+
+Times `python3 app-gen.py --help` in fresh interpreters, prints the modules
+with the largest cumulative import time (python -X importtime) and checks
+that none of the heavy modules, only needed by some stages, is imported
+when app-gen.py is loaded. Exits with status 1 if one is.
+
+Usage:
+    python3 benchmarks/bench_import.py [-r runs] [-t top]
+"""
+import getopt
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+APP_GEN_PY = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'app-gen.py')
+
+# modules the stages import on first use
+HEAVY_MODULES = ['yaml', 'subprocess', 'hashlib', 'tarfile', 'gzip', 'zipfile', 'configparser',
+                 'concurrent.futures', 'urllib.request', 'cProfile', 'asyncio']
+
+LOAD_APP_GEN = """
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location('app_gen', %r)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(' '.join(name for name in %r if name in sys.modules))
+""" % (APP_GEN_PY, HEAVY_MODULES)
+
+
+def help_time(runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, APP_GEN_PY, '--help'], stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+
+def import_times():
+    proc = subprocess.run([sys.executable, '-X', 'importtime', APP_GEN_PY, '--help'],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    modules = []
+    for line in proc.stderr.decode().splitlines():
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        modules.append((int(fields[1]), fields[2].strip()))
+    return sorted(modules, reverse=True)
+
+
+def main(argv):
+    runs = 20
+    top = 10
+    options, args = getopt.getopt(argv, 'r:t:')
+    for option, value in options:
+        if option == '-r':
+            runs = int(value)
+        if option == '-t':
+            top = int(value)
+
+    best, median = help_time(runs)
+    print('app-gen.py --help, %d runs' % runs)
+    print('best:   %8.2f ms' % (best * 1000))
+    print('median: %8.2f ms' % (median * 1000))
+    print('')
+    print('largest cumulative import times:')
+    for cumulative, name in import_times()[:top]:
+        print('%8.2f ms  %s' % (cumulative / 1000, name))
+
+    proc = subprocess.run([sys.executable, '-c', LOAD_APP_GEN], stdout=subprocess.PIPE, check=True)
+    loaded = proc.stdout.decode().split()
+    if loaded:
+        print('Error: heavy modules imported at load: %s' % ', '.join(loaded))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,136 @@
+"""
+Benchmark of the FluxCD template rendering.
+
+Renders the fluxcd-manifest templates for N synthetic charts with the
+previous line by line engine and with the compiled render plans, checks
+that both outputs are byte-identical and prints the speedup.
+
+Usage:
+    python3 benchmarks/bench_render.py [-n charts] [-r rounds]
+"""
+import getopt
+import importlib.util
+import os
+import re
+import sys
+import time
+
+APP_GEN_PY = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'app-gen.py')
+
+
+def load_app_gen():
+    spec = importlib.util.spec_from_file_location('app_gen', APP_GEN_PY)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Previous engine: every template line goes through the values regex and,
+# when nothing was substituted, through the blocks regex
+def legacy_substitute_values(in_line, dicts, to_camel_case):
+    out_line = in_line
+    pattern = re.compile(r'\$.+?\$')
+    results = pattern.findall(out_line)
+    if results:
+        for result in results:
+            result_word = result.strip('$').split('%')
+            value_key = result_word[0]
+            value_default = ''
+            if len(result_word) > 1:
+                value_default = result_word[1]
+            value = to_camel_case(value_key)
+            if value in dicts:
+                out_line = out_line.replace(result, str(dicts[value]))
+            elif value_default:
+                out_line = out_line.replace(result, value_default)
+    return out_line, out_line != in_line
+
+
+def legacy_substitute_blocks(in_line, dicts, write_block):
+    out_line = in_line
+    result = re.search(r'@\S+\|\d+@', out_line)
+    if result:
+        block_key = result.group().strip('@').split('|')
+        key = block_key[0].lower()
+        indent = int(block_key[1])
+        if key in dicts:
+            out_line = write_block(key, dicts[key], indent)
+        else:
+            out_line = ''
+    return out_line
+
+
+def legacy_render(template, dicts, app_gen, write_block):
+    with open(os.path.join(app_gen.APP_GEN_PY_PATH, template), 'r') as f:
+        schema = f.readlines()
+    out = []
+    for line in schema:
+        out_line, substituted = legacy_substitute_values(line, dicts, app_gen.to_camel_case)
+        if not substituted:
+            out_line = legacy_substitute_blocks(line, dicts, write_block)
+        out.append(out_line)
+    return ''.join(out)
+
+
+def plan_render(template, dicts, app_gen, write_block):
+    return app_gen.load_templates().plan(template).render(dicts, write_block)
+
+
+def synthetic_app(n_charts):
+    charts = []
+    for i in range(n_charts):
+        charts.append({'name': 'chart-%d' % i, 'version': '1.0.%d' % i,
+                       'path': '/charts/chart-%d' % i})
+    return {
+        'appManifestFile-config': {
+            'appName': 'bench-app', 'appVersion': '1.0', 'namespace': 'bench',
+            'chart': charts},
+        'metadataFile-config': None,
+        'setupFile-config': {'metadata': {}},
+    }
+
+
+def bench(render, app_gen, app, rounds):
+    templates = [app_gen.SCHEMA_MANIFEST_HELMRELEASE_TEMPLATE,
+                 app_gen.SCHEMA_MANIFEST_KUSTOMIZATION_TEMPLATE]
+    kustomization = app_gen.SCHEMA_KUSTOMIZATION_TEMPLATE
+    write_block = app._write_yaml_to_manifest
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        out = [render(kustomization, app._flux_chart_group, app_gen, write_block)]
+        for chart in app._flux_chart:
+            for template in templates:
+                out.append(render(template, chart, app_gen, write_block))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def main(argv):
+    n_charts = 500
+    rounds = 5
+    options, args = getopt.getopt(argv, 'n:r:')
+    for option, value in options:
+        if option == '-n':
+            n_charts = int(value)
+        if option == '-r':
+            rounds = int(value)
+
+    app_gen = load_app_gen()
+    app = app_gen.FluxApplication(synthetic_app(n_charts))
+
+    legacy_time, legacy_out = bench(legacy_render, app_gen, app, rounds)
+    plan_time, plan_out = bench(plan_render, app_gen, app, rounds)
+    if legacy_out != plan_out:
+        print('Error: render plan output differs from the line by line engine')
+        sys.exit(1)
+
+    print('charts: %d, best of %d rounds' % (n_charts, rounds))
+    print('line by line engine: %8.2f ms' % (legacy_time * 1000))
+    print('render plans:        %8.2f ms' % (plan_time * 1000))
+    print('speedup:             %8.2fx' % (legacy_time / plan_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
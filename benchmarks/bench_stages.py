@@ -0,0 +1,231 @@
+"""
+Benchmark of the application generation stages.
+
+Generates synthetic applications of N dummy helm charts (10, 100 and 1000
+by default) and times each stage on its own: the FluxCD manifest, plugins,
+setup.cfg and metadata rendering, the output write, the helm chart
+packaging, through a stub helm put first on PATH, and the checksum and
+application tarball. No network nor real helm is needed.
+
+For every stage the best time of the rounds, the charts throughput and the
+peak python memory (tracemalloc, measured in a separate run) are printed
+and compared with a baseline. A stage slower than the baseline by more than
+the threshold is reported as a regression and the exit status is 1.
+
+Usage:
+    python3 benchmarks/bench_stages.py [-n charts[,charts...]] [-r rounds]
+        [--baseline file] [--save-baseline] [--threshold percent]
+"""
+import contextlib
+import copy
+import getopt
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+APP_GEN_PY = os.path.join(BENCH_DIR, '..', 'app-gen.py')
+BASELINE_FILE = os.path.join(BENCH_DIR, 'bench_stages_baseline.json')
+
+# lint does nothing, package tars the chart dir as <name>-<version>.tgz
+STUB_HELM = """#!/bin/sh
+case "$1" in
+lint)
+    echo "==> Linting $2"
+    echo "1 chart(s) linted, 0 chart(s) failed"
+    ;;
+package)
+    name=$(basename "$2")
+    dest=${3#--destination=}
+    tar -czf "$dest/$name-0.1.0.tgz" -C "$(dirname "$2")" "$name" || exit 1
+    echo "Successfully packaged chart and saved it to: $dest/$name-0.1.0.tgz"
+    ;;
+*)
+    exit 1
+    ;;
+esac
+"""
+
+CHART_FILES = {
+    'Chart.yaml': 'apiVersion: v2\nname: %(name)s\nversion: 0.1.0\nappVersion: "1.0"\n',
+    'values.yaml': 'replicaCount: 1\nimage:\n  repository: nginx\n  tag: "1.0"\n',
+    'templates/configmap.yaml': 'apiVersion: v1\nkind: ConfigMap\nmetadata:\n'
+                                '  name: {{ .Release.Name }}\ndata:\n  chart: %(name)s\n',
+}
+
+
+def load_app_gen():
+    spec = importlib.util.spec_from_file_location('app_gen', APP_GEN_PY)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_env(root, n_charts):
+    bin_dir = os.path.join(root, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    with open(os.path.join(bin_dir, 'helm'), 'w') as f:
+        f.write(STUB_HELM)
+    os.chmod(os.path.join(bin_dir, 'helm'), 0o755)
+
+    charts = []
+    for i in range(n_charts):
+        name = 'chart-%d' % i
+        for rel_path, content in CHART_FILES.items():
+            path = os.path.join(root, 'charts', name, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content % {'name': name})
+        charts.append({'name': name, 'version': '0.1.0', 'path': os.path.join(root, 'charts', name)})
+    return {
+        'appManifestFile-config': {
+            'appName': 'bench-app', 'appVersion': '1.0.0', 'namespace': 'bench',
+            'chart': charts},
+        'metadataFile-config': {'maintain_user_overrides': True},
+        'setupFile-config': {'metadata': {
+            'author': 'bench', 'author-email': 'bench@example.com',
+            'url': 'https://example.com',
+            'classifier': ['Operating System :: POSIX :: Linux']}},
+    }
+
+
+def new_app(app_gen, app_data, out_dir):
+    app = app_gen.FluxApplication(copy.deepcopy(app_data))
+    app._jobs = os.cpu_count() or 1
+    app._set_output_dir(out_dir)
+    app._stager = app_gen.OutputStager(out_dir)
+    app._create_flux_dir(out_dir)
+    app._create_plugins_dir()
+    return app
+
+
+def render(app):
+    app._gen_fluxcd_manifest()
+    app._gen_plugins()
+    app._gen_metadata()
+
+
+def clean_charts(app):
+    shutil.rmtree(app._flux_manifest['outputChartDir'], ignore_errors=True)
+    os.makedirs(app._flux_manifest['outputChartDir'])
+
+
+# (stage, prepare, run), prepare being untimed
+STAGES = [
+    ('fluxcd manifest', None, lambda app: app._gen_fluxcd_manifest()),
+    ('plugins', None, lambda app: app._gen_plugins()),
+    ('app setup', None, lambda app: app.write_app_setup()),
+    ('metadata', None, lambda app: app._gen_metadata()),
+    ('write output', render, lambda app: app._stager.commit()),
+    ('helm charts', clean_charts, lambda app: app._gen_helm_chart_tarballs()),
+    ('app tarball', None, lambda app: app._gen_checksum_and_app_tarball()),
+]
+
+
+def run_stage(app_gen, app_data, out_dir, prepare, run, trace=False):
+    app = new_app(app_gen, app_data, out_dir)
+    if prepare:
+        prepare(app)
+    with contextlib.redirect_stdout(io.StringIO()):
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        ret = run(app)
+        elapsed = time.perf_counter() - start
+        peak = 0
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    if ret is False:
+        raise RuntimeError('stage failed')
+    return elapsed, peak
+
+
+def bench(app_gen, n_charts, rounds):
+    results = dict()
+    with tempfile.TemporaryDirectory(prefix='bench-stages-') as root:
+        app_data = make_env(root, n_charts)
+        if not app_gen.check_manifest(app_data):
+            raise RuntimeError('invalid synthetic manifest')
+        path = os.environ['PATH']
+        os.environ['PATH'] = os.path.join(root, 'bin') + os.pathsep + path
+        out_dir = os.path.join(root, 'out', 'bench-app')
+        try:
+            # the application tarball stage needs a complete output dir
+            app = new_app(app_gen, app_data, out_dir)
+            render(app)
+            app._stager.commit()
+            with contextlib.redirect_stdout(io.StringIO()):
+                app._gen_helm_chart_tarballs()
+                app._gen_plugin_wheels()
+
+            for name, prepare, run in STAGES:
+                best = min(run_stage(app_gen, app_data, out_dir, prepare, run)[0] for _ in range(rounds))
+                peak = run_stage(app_gen, app_data, out_dir, prepare, run, trace=True)[1]
+                results['%d/%s' % (n_charts, name)] = {'time': best, 'peak': peak}
+        finally:
+            os.environ['PATH'] = path
+    return results
+
+
+def main(argv):
+    sizes = [10, 100, 1000]
+    rounds = 5
+    baseline_file = BASELINE_FILE
+    save_baseline = False
+    threshold = 20.0
+    options, args = getopt.getopt(argv, 'n:r:', ['baseline=', 'save-baseline', 'threshold='])
+    for option, value in options:
+        if option == '-n':
+            sizes = [int(size) for size in value.split(',')]
+        if option == '-r':
+            rounds = int(value)
+        if option == '--baseline':
+            baseline_file = value
+        if option == '--save-baseline':
+            save_baseline = True
+        if option == '--threshold':
+            threshold = float(value)
+
+    app_gen = load_app_gen()
+    results = dict()
+    for n_charts in sizes:
+        results.update(bench(app_gen, n_charts, rounds))
+
+    baseline = dict()
+    if os.path.exists(baseline_file) and not save_baseline:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+
+    regressions = []
+    print('best of %d rounds' % rounds)
+    print('%-22s %10s %12s %10s %10s' % ('charts/stage', 'time ms', 'charts/s', 'peak KiB', 'baseline'))
+    for key, result in results.items():
+        n_charts = int(key.split('/')[0])
+        change = ''
+        if key in baseline:
+            ratio = result['time'] / baseline[key]['time'] * 100 - 100
+            change = '%+.1f%%' % ratio
+            if ratio > threshold:
+                change += ' REGRESSION'
+                regressions.append(key)
+        print('%-22s %10.2f %12.0f %10.1f %10s' % (key, result['time'] * 1000, \
+                n_charts / result['time'], result['peak'] / 1024, change))
+
+    if save_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Baseline saved to %s' % baseline_file)
+    if regressions:
+        print('Error: %d stages slower than the baseline by more than %.0f%%' % (len(regressions), threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
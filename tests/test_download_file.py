@@ -0,0 +1,168 @@
+"""
+Tests of download_file against a local HTTP server supporting range requests.
+
+Usage:
+    python3 -m unittest discover -s tests
+"""
+import hashlib
+import http.server
+import importlib.util
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+APP_GEN_PY = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'app-gen.py')
+
+CONTENT = bytes(range(256)) * 4096
+
+
+def load_app_gen():
+    spec = importlib.util.spec_from_file_location('app_gen', APP_GEN_PY)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    serves CONTENT, honoring 'Range: bytes=N-' unless server.ranges is False,
+    and stalling server.stall seconds half way through.
+    """
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        start = 0
+        if self.server.ranges and self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(CONTENT))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(CONTENT) - 1, len(CONTENT)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT) - start))
+        self.end_headers()
+        half = start + (len(CONTENT) - start) // 2
+        self.wfile.write(CONTENT[start:half])
+        self.wfile.flush()
+        time.sleep(self.server.stall)
+        self.wfile.write(CONTENT[half:])
+
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadFileTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app_gen = load_app_gen()
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        cls.server.requests = []
+        cls.server.ranges = True
+        cls.server.stall = 0
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = 'http://127.0.0.1:%d/chart.tgz' % cls.server.server_address[1]
+        cls.sha256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+
+    def setUp(self):
+        self.server.requests.clear()
+        self.server.ranges = True
+        self.server.stall = 0
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.tmp_dir.name, 'chart.tgz')
+
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+    def write_part(self, data):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(data)
+
+
+    def assertDownloaded(self):
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+
+    def test_download(self):
+        self.app_gen.download_file(self.url, self.dest, self.sha256)
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests, [None])
+
+
+    def test_resume(self):
+        self.write_part(CONTENT[:1000])
+        self.app_gen.download_file(self.url, self.dest, self.sha256)
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests, ['bytes=1000-'])
+
+
+    def test_resume_without_range_support(self):
+        self.server.ranges = False
+        self.write_part(CONTENT[:1000])
+        self.app_gen.download_file(self.url, self.dest, self.sha256)
+        self.assertDownloaded()
+
+
+    def test_part_over_remote_size(self):
+        self.write_part(CONTENT + b'stale')
+        self.app_gen.download_file(self.url, self.dest, self.sha256)
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests, ['bytes=%d-' % (len(CONTENT) + 5), None])
+
+
+    def test_sha256_mismatch(self):
+        with self.assertRaises(ValueError):
+            self.app_gen.download_file(self.url, self.dest, '0' * 64)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+
+    def test_corrupted_part(self):
+        self.write_part(b'x' * 1000)
+        with self.assertRaises(ValueError):
+            self.app_gen.download_file(self.url, self.dest, self.sha256)
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+        # the next run starts over
+        self.app_gen.download_file(self.url, self.dest, self.sha256)
+        self.assertDownloaded()
+
+
+    def test_stalled_server(self):
+        self.server.stall = 2
+        timeout = self.app_gen.PREFETCH_TIMEOUT
+        self.app_gen.PREFETCH_TIMEOUT = 0.2
+        try:
+            with self.assertRaises(OSError) as raised:
+                self.app_gen.download_file(self.url, self.dest, self.sha256)
+        finally:
+            self.app_gen.PREFETCH_TIMEOUT = timeout
+        # no HTTP error code, the prefetch retries it
+        self.assertIsNone(getattr(raised.exception, 'code', None))
+        self.assertEqual(os.path.getsize(self.dest + '.part'), len(CONTENT) // 2)
+        # the retry resumes the partial download
+        self.server.stall = 0
+        self.app_gen.download_file(self.url, self.dest, self.sha256)
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests, [None, 'bytes=%d-' % (len(CONTENT) // 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+Tests of extract_tar_subpath and read_tar_file on the layouts of chart
+tarballs, and on archives with symlinks pointing out of the chart.
+
+Usage:
+    python3 -m unittest discover -s tests
+"""
+import importlib.util
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+APP_GEN_PY = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'app-gen.py')
+
+CHART_YAML = b'apiVersion: v2\nname: gamma\nversion: 1.2.3\n'
+
+
+def load_app_gen():
+    spec = importlib.util.spec_from_file_location('app_gen', APP_GEN_PY)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ExtractTarSubpathTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app_gen = load_app_gen()
+
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        self.dest = os.path.join(self.root, 'out', 'chart')
+
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+    # members: (name, content) for files, (name, None) for dirs and
+    # (name, '->target') for symlinks
+    def make_tar(self, members):
+        path = os.path.join(self.root, 'chart.tgz')
+        with tarfile.open(path, 'w:gz') as tar:
+            for name, content in members:
+                info = tarfile.TarInfo(name)
+                if content is None:
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                elif isinstance(content, str):
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = content[2:]
+                    tar.addfile(info)
+                else:
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+        return path
+
+
+    def read_dest(self, rel_path):
+        with open(os.path.join(self.dest, rel_path), 'rb') as f:
+            return f.read()
+
+
+    def test_helm_package(self):
+        path = self.make_tar([('gamma/Chart.yaml', CHART_YAML), ('gamma/templates/cm.yaml', b'cm')])
+        for subpath in ('.', ''):
+            self.app_gen.extract_tar_subpath(path, subpath, self.dest)
+            self.assertEqual(sorted(os.listdir(self.dest)), ['Chart.yaml', 'templates'])
+            self.assertEqual(self.read_dest('templates/cm.yaml'), b'cm')
+        self.assertEqual(self.app_gen.read_tar_file(path, 'Chart.yaml'), CHART_YAML)
+
+
+    def test_no_arcname(self):
+        path = self.make_tar([('Chart.yaml', CHART_YAML), ('templates/cm.yaml', b'cm')])
+        for subpath in ('.', ''):
+            self.app_gen.extract_tar_subpath(path, subpath, self.dest)
+            self.assertEqual(sorted(os.listdir(self.dest)), ['Chart.yaml', 'templates'])
+            self.assertEqual(self.read_dest('templates/cm.yaml'), b'cm')
+        self.assertEqual(self.app_gen.read_tar_file(path, 'Chart.yaml'), CHART_YAML)
+
+
+    def test_dot_members(self):
+        # tar -C dir .
+        path = self.make_tar([('.', None), ('./alpha', None), ('./alpha/Chart.yaml', CHART_YAML),
+                              ('./alpha/templates/cm.yaml', b'cm')])
+        self.assertEqual(self.app_gen.read_tar_file(path, 'Chart.yaml'), CHART_YAML)
+        self.app_gen.extract_tar_subpath(path, '.', self.dest)
+        self.assertEqual(sorted(os.listdir(self.dest)), ['Chart.yaml', 'templates'])
+        path = self.make_tar([('.', None), ('./Chart.yaml', CHART_YAML), ('./templates/cm.yaml', b'cm')])
+        self.assertEqual(self.app_gen.read_tar_file(path, 'Chart.yaml'), CHART_YAML)
+        self.app_gen.extract_tar_subpath(path, '.', self.dest)
+        self.assertEqual(sorted(os.listdir(self.dest)), ['Chart.yaml', 'templates'])
+
+
+    def test_arcname_subpath(self):
+        path = self.make_tar([('repo-1.0/README', b'readme'), ('repo-1.0/charts/gamma/Chart.yaml', CHART_YAML),
+                              ('repo-1.0/charts/delta/Chart.yaml', b'delta')])
+        self.app_gen.extract_tar_subpath(path, 'charts/gamma', self.dest)
+        self.assertEqual(os.listdir(self.dest), ['Chart.yaml'])
+        self.assertEqual(self.app_gen.read_tar_file(path, 'charts/gamma/Chart.yaml'), CHART_YAML)
+
+
+    def test_root_subpath(self):
+        path = self.make_tar([('README', b'readme'), ('charts/gamma/Chart.yaml', CHART_YAML)])
+        self.app_gen.extract_tar_subpath(path, 'charts/gamma', self.dest)
+        self.assertEqual(os.listdir(self.dest), ['Chart.yaml'])
+        self.assertEqual(self.app_gen.read_tar_file(path, 'charts/gamma/Chart.yaml'), CHART_YAML)
+
+
+    def test_missing_subpath(self):
+        path = self.make_tar([('gamma/Chart.yaml', CHART_YAML)])
+        with self.assertRaises(FileNotFoundError):
+            self.app_gen.extract_tar_subpath(path, 'delta', self.dest)
+        self.assertIsNone(self.app_gen.read_tar_file(path, 'delta/Chart.yaml'))
+
+
+    def test_symlink_escape(self):
+        escaped = os.path.join(self.root, 'escaped')
+        os.makedirs(escaped)
+        path = self.make_tar([('arc/sub/Chart.yaml', CHART_YAML),
+                              ('arc/sub/link', '->' + os.path.relpath(escaped, os.path.dirname(self.dest))),
+                              ('arc/sub/link/pwned', b'pwned'),
+                              ('arc/sub/up', '->' + os.path.relpath(escaped, self.dest + '.tmp/arc/sub')),
+                              ('arc/sub/up/pwned', b'pwned'),
+                              ('arc/sub/abs', '->' + escaped)])
+        self.app_gen.extract_tar_subpath(path, 'sub', self.dest)
+        self.assertEqual(os.listdir(escaped), [])
+        for link_name in ('link', 'up', 'abs'):
+            self.assertFalse(os.path.islink(os.path.join(self.dest, link_name)))
+
+
+    def test_symlinks_inside_chart(self):
+        path = self.make_tar([('arc/sub/Chart.yaml', CHART_YAML), ('arc/sub/values.yaml', b'values'),
+                              ('arc/other/secret', b'secret'),
+                              ('arc/sub/templates/values.yaml', '->../values.yaml'),
+                              ('arc/sub/other', '->../other/secret')])
+        self.app_gen.extract_tar_subpath(path, 'sub', self.dest)
+        self.assertEqual(self.read_dest('templates/values.yaml'), b'values')
+        self.assertFalse(os.path.lexists(os.path.join(self.dest, 'other')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Tests of --incremental runs changing the packaging options, compared to
+clean builds. They run app-gen.py and need helm, they are skipped without
+it.
+
+Usage:
+    python3 -m unittest discover -s tests
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+APP_GEN_PY = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'app-gen.py')
+
+APP_MANIFEST = """\
+appManifestFile-config:
+  appName: demo-app
+  appVersion: 1.0.0
+  namespace: demo
+  chart:
+    - name: demo-chart
+      version: 0.1.0
+      path: %s
+metadataFile-config:
+  maintain_user_overrides: true
+setupFile-config:
+  metadata:
+    author: Jane
+    author-email: jane@example.com
+    url: https://example.com
+    classifier:
+      - "Operating System :: POSIX :: Linux"
+"""
+
+CHART_FILES = {
+    'Chart.yaml': 'apiVersion: v2\nname: demo-chart\nversion: 0.1.0\n',
+    'values.yaml': 'replicas: 1\n',
+    'templates/cm.yaml': 'apiVersion: v1\nkind: ConfigMap\nmetadata:\n  name: demo\n',
+}
+
+
+@unittest.skipUnless(shutil.which('helm'), 'helm not found')
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        chart_dir = os.path.join(self.root, 'demo-chart')
+        for rel_path, content in CHART_FILES.items():
+            os.makedirs(os.path.dirname(os.path.join(chart_dir, rel_path)), exist_ok=True)
+            with open(os.path.join(chart_dir, rel_path), 'w') as f:
+                f.write(content)
+        self.manifest = os.path.join(self.root, 'app_manifest.yaml')
+        with open(self.manifest, 'w') as f:
+            f.write(APP_MANIFEST % chart_dir)
+        self.env = dict(os.environ, SOURCE_DATE_EPOCH='1700000000')
+
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+    # Run app-gen.py into the output folder name, return its stdout
+    def app_gen(self, name, *options):
+        subproc = subprocess.run([sys.executable, APP_GEN_PY, '-i', self.manifest, '-o', os.path.join(self.root, name),
+                                  '--chart-cache', os.path.join(self.root, 'chart-cache')] + list(options),
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=self.env)
+        output = str(subproc.stdout, encoding = 'utf-8')
+        self.assertEqual(subproc.returncode, 0, output)
+        return output
+
+
+    def tarball_sha256(self, name):
+        with open(os.path.join(self.root, name, 'demo-app', 'demo-app-1.0.0.tgz'), 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+
+    def test_compress_change(self):
+        self.app_gen('clean', '--compress', 'store', '--reproducible')
+        self.app_gen('inc', '--incremental', '--reproducible')
+        self.assertIn('App tarball up to date', self.app_gen('inc', '--incremental', '--reproducible'))
+        output = self.app_gen('inc', '--incremental', '--compress', 'store', '--reproducible')
+        self.assertNotIn('App tarball up to date', output)
+        self.assertEqual(self.tarball_sha256('inc'), self.tarball_sha256('clean'))
+
+
+    def test_reproducible_change(self):
+        self.app_gen('clean', '--reproducible')
+        self.app_gen('inc', '--incremental')
+        output = self.app_gen('inc', '--incremental', '--reproducible')
+        self.assertNotIn('Plugin wheels up to date', output)
+        self.assertEqual(self.tarball_sha256('inc'), self.tarball_sha256('clean'))
+        # SOURCE_DATE_EPOCH is the mtime of every member
+        self.env['SOURCE_DATE_EPOCH'] = '1700000001'
+        self.app_gen('clean', '--reproducible', '--overwrite')
+        self.app_gen('inc', '--incremental', '--reproducible')
+        self.assertEqual(self.tarball_sha256('inc'), self.tarball_sha256('clean'))
+
+
+if __name__ == '__main__':
+    unittest.main()
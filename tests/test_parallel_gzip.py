@@ -0,0 +1,81 @@
+"""
+Tests of ParallelGzipWriter, the deflate blocks compressed in parallel
+being decompressed with gzip and compared to the input.
+
+Usage:
+    python3 -m unittest discover -s tests
+"""
+import gzip
+import importlib.util
+import io
+import os
+import random
+import unittest
+
+APP_GEN_PY = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'app-gen.py')
+
+
+def load_app_gen():
+    spec = importlib.util.spec_from_file_location('app_gen', APP_GEN_PY)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ParallelGzipWriterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app_gen = load_app_gen()
+
+
+    # Compress data written in chunks of chunk_size bytes
+    def compress(self, data, chunk_size=65536, **kwargs):
+        raw = io.BytesIO()
+        with self.app_gen.ParallelGzipWriter(raw, **kwargs) as writer:
+            for start in range(0, len(data), chunk_size):
+                writer.write(data[start:start + chunk_size])
+        return raw.getvalue()
+
+
+    def test_multi_block(self):
+        rand = random.Random(0)
+        words = [bytes(rand.choice(b'abcdefgh') for _ in range(8)) for _ in range(256)]
+        block_size = self.app_gen.ParallelGzipWriter.BLOCK_SIZE
+        data = b' '.join(rand.choice(words) for _ in range(block_size // 2))
+        self.assertGreater(len(data), 4 * block_size)
+        # more blocks than the jobs and the pending blocks
+        for jobs in (1, 2):
+            compressed = self.compress(data, 100000, jobs=jobs)
+            self.assertEqual(gzip.decompress(compressed), data)
+            self.assertLess(len(compressed), len(data) // 2)
+
+
+    def test_window_priming(self):
+        block_size = self.app_gen.ParallelGzipWriter.BLOCK_SIZE
+        window_size = self.app_gen.ParallelGzipWriter.WINDOW_SIZE
+        noise = random.Random(1).getrandbits(8 * block_size).to_bytes(block_size, 'little')
+        # the second block only repeats the end of the first one, which costs
+        # a few bytes when the window primes the second block
+        data = noise + noise[-window_size // 2:]
+        compressed = self.compress(data, compresslevel=6)
+        self.assertEqual(gzip.decompress(compressed), data)
+        self.assertLess(len(compressed), len(self.compress(noise, compresslevel=6)) + 1024)
+
+
+    def test_empty(self):
+        compressed = self.compress(b'')
+        self.assertEqual(gzip.decompress(compressed), b'')
+        self.assertEqual(compressed[:2], b'\x1f\x8b')
+
+
+    def test_header(self):
+        data = b'starlingx\n' * 1000
+        compressed = self.compress(data, 7, compresslevel=9, mtime=0)
+        self.assertEqual(gzip.decompress(compressed), data)
+        self.assertEqual(compressed[4:8], b'\0\0\0\0')
+        self.assertEqual(compressed, self.compress(data, 7, compresslevel=9, mtime=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+"""
+Tests of the plugin wheels built in process: RECORD against the archive
+content, and the METADATA, WHEEL and entry_points.txt of the wheel of a
+generated application.
+
+Usage:
+    python3 -m unittest discover -s tests
+"""
+import base64
+import configparser
+import csv
+import email.parser
+import hashlib
+import importlib.util
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+APP_GEN_PY = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'app-gen.py')
+
+APP_MANIFEST = """\
+appManifestFile-config:
+  appName: demo-app
+  appVersion: 1.0.0
+  namespace: demo
+  chart:
+    - name: demo-chart
+      version: 0.1.0
+      path: %s
+metadataFile-config:
+  maintain_user_overrides: true
+setupFile-config:
+  metadata:
+    author: Jane
+    author-email: jane@example.com
+    url: https://example.com
+    classifier:
+      - "Operating System :: POSIX :: Linux"
+      - "Programming Language :: Python"
+"""
+
+DATE_TIME = (2024, 1, 2, 3, 4, 6)
+
+
+def load_app_gen():
+    spec = importlib.util.spec_from_file_location('app_gen', APP_GEN_PY)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class WriteWheelTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app_gen = load_app_gen()
+
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+    # Check RECORD against the content of the wheel, return the wheel files
+    def check_record(self, path, dist_info):
+        with zipfile.ZipFile(path) as whl:
+            names = whl.namelist()
+            files = {name: whl.read(name) for name in names}
+            for info in whl.infolist():
+                self.assertEqual(info.date_time, DATE_TIME)
+        # the dist-info files come last, RECORD at the very end
+        self.assertEqual(names[-1], dist_info + '/RECORD')
+        dist_files = [name for name in names if name.startswith(dist_info + '/')]
+        self.assertEqual(names[-len(dist_files):], dist_files)
+
+        rows = list(csv.reader(io.StringIO(files[dist_info + '/RECORD'].decode())))
+        self.assertEqual(sorted(row[0] for row in rows), sorted(names))
+        for name, digest, size in rows:
+            if name == dist_info + '/RECORD':
+                self.assertEqual((digest, size), ('', ''))
+                continue
+            expected = base64.urlsafe_b64encode(hashlib.sha256(files[name]).digest()).rstrip(b'=').decode()
+            self.assertEqual(digest, 'sha256=' + expected, name)
+            self.assertEqual(int(size), len(files[name]), name)
+        return files
+
+
+    def test_record(self):
+        dist_info = 'demo-1.0.0.dist-info'
+        files = {
+            'demo/__init__.py': b'',
+            'demo/helm/chart.py': b'class Chart:\n    pass\n' * 100,
+            dist_info + '/METADATA': b'Metadata-Version: 2.1\nName: demo\nVersion: 1.0.0\n',
+            dist_info + '/WHEEL': b'Wheel-Version: 1.0\n',
+        }
+        path = os.path.join(self.root, 'demo-1.0.0-py2.py3-none-any.whl')
+        self.app_gen.write_wheel(path, files, dist_info, DATE_TIME)
+        content = self.check_record(path, dist_info)
+        for name, data in files.items():
+            self.assertEqual(content[name], data)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        # the same files and date make the same wheel
+        with open(path, 'rb') as f:
+            first = f.read()
+        self.app_gen.write_wheel(path, files, dist_info, DATE_TIME)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), first)
+
+
+    def test_plugin_wheel(self):
+        chart_dir = os.path.join(self.root, 'demo-chart')
+        os.makedirs(chart_dir)
+        with open(os.path.join(chart_dir, 'Chart.yaml'), 'w') as f:
+            f.write('apiVersion: v2\nname: demo-chart\nversion: 0.1.0\n')
+        manifest = os.path.join(self.root, 'app_manifest.yaml')
+        with open(manifest, 'w') as f:
+            f.write(APP_MANIFEST % chart_dir)
+
+        # render the application, then build its wheel
+        app_data = self.app_gen.parse_yaml(manifest)
+        self.assertTrue(self.app_gen.check_manifest(app_data))
+        app = self.app_gen.FluxApplication(app_data, self.app_gen.load_templates())
+        app_out = os.path.join(self.root, 'out', 'demo-app')
+        with mock.patch.dict(os.environ, {'SOURCE_DATE_EPOCH': '1704164646'}), \
+                mock.patch('sys.stdout', io.StringIO()):
+            os.environ.pop('PBR_VERSION', None)
+            try:
+                self.assertTrue(app.gen_app(app_out, False, True, False))
+                app._reproducible = True
+                self.assertTrue(app._gen_plugin_wheels())
+            finally:
+                app.release_fetch_entries()
+
+        dist_info = 'k8sapp_demo_app-1.0.0.dist-info'
+        files = self.check_record(os.path.join(app_out, 'plugins', 'k8sapp_demo_app-1.0.0-py2.py3-none-any.whl'),
+                                  dist_info)
+        self.assertIn('k8sapp_demo_app/__init__.py', files)
+        self.assertIn('k8sapp_demo_app/helm/demo_chart.py', files)
+
+        metadata = email.parser.Parser().parsestr(files[dist_info + '/METADATA'].decode())
+        self.assertEqual(metadata['Metadata-Version'], '2.1')
+        self.assertEqual(metadata['Name'], 'k8sapp-demo-app')
+        self.assertEqual(metadata['Version'], '1.0.0')
+        self.assertEqual(metadata['Author'], 'Jane')
+        self.assertEqual(metadata['Author-email'], 'jane@example.com')
+        self.assertEqual(metadata['Home-page'], 'https://example.com')
+        self.assertEqual(metadata.get_all('Classifier'),
+                         ['Operating System :: POSIX :: Linux', 'Programming Language :: Python'])
+
+        wheel = email.parser.Parser().parsestr(files[dist_info + '/WHEEL'].decode())
+        self.assertEqual(wheel['Wheel-Version'], '1.0')
+        self.assertEqual(wheel['Root-Is-Purelib'], 'true')
+        self.assertEqual(wheel.get_all('Tag'), ['py2-none-any', 'py3-none-any'])
+        self.assertEqual(files[dist_info + '/top_level.txt'], b'k8sapp_demo_app\n')
+
+        # entry_points.txt holds the entry points of setup.cfg
+        setup_cfg = configparser.ConfigParser(delimiters=('=',), interpolation=None)
+        setup_cfg.optionxform = str
+        setup_cfg.read(os.path.join(app_out, 'plugins', 'setup.cfg'))
+        entry_points = configparser.ConfigParser(delimiters=('=',), interpolation=None)
+        entry_points.optionxform = str
+        entry_points.read_string(files[dist_info + '/entry_points.txt'].decode())
+        expected = {group: {entry.split('=')[0].strip(): entry.split('=', 1)[1].strip()
+                            for entry in entries.strip().split('\n')}
+                    for group, entries in setup_cfg['entry_points'].items()}
+        self.assertEqual({group: dict(entry_points[group]) for group in entry_points.sections()}, expected)
+        self.assertIn('systemconfig.helm_plugins.demo_app', expected)
+        self.assertEqual(expected['systemconfig.helm_plugins.demo_app'],
+                         {'001_demo-chart': 'k8sapp_demo_app.helm.demo_chart:DemoChartHelm'})
+
+
+if __name__ == '__main__':
+    unittest.main()